@@ -0,0 +1,524 @@
+""" Benchmarks for the ingestion and search hot paths.
+
+Everything runs against local stand-ins so no credentials or network are needed:
+synthetic images are served over HTTP in place of the Discord CDN, Google Vision
+is replaced with a fake client with a configurable latency, and Elasticsearch
+with an in-memory fake. Pass --es-host to run the Elasticsearch stages against
+a real cluster instead.
+
+    python bench.py --images 200 --vision-latency 0.15 --json ../bench_output.json
+
+Every stage reports throughput, p50/p95/p99 latency and peak Python memory.
+"""
+import argparse
+import asyncio
+import functools
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datetime import datetime
+from types import SimpleNamespace
+
+SRC = os.path.dirname(os.path.abspath(__file__))
+
+WORDS = ('week', 'bot', 'search', 'image', 'server', 'meme', 'cat', 'dog', 'night', 'coffee',
+         'deadline', 'exam', 'lecture', 'python', 'discord', 'elastic', 'vision', 'queue',
+         'cache', 'pizza', 'monday', 'friday', 'error', 'stack', 'trace', 'deploy')
+
+
+def words_for(content: bytes, count=12) -> str:
+    """ Deterministic pseudo OCR text for an image """
+    rng = random.Random(hashlib.md5(content).digest())
+
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def make_corpus(count: int, seed=0) -> list:
+    """ Synthetic screenshots: random sizes with a few lines of text drawn on them
+
+    Returns:
+        list -- PNG bytes
+    """
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(count):
+        width, height = rng.randint(400, 2400), rng.randint(300, 1800)
+        image = Image.new('RGB', (width, height), (rng.randint(200, 255),) * 3)
+        draw = ImageDraw.Draw(image)
+        for line in range(rng.randint(2, 8)):
+            text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 10)))
+            draw.text((20, 20 + line * 30), f'{i} {text}', fill=(0, 0, 0))
+
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        corpus.append(buffer.getvalue())
+
+    return corpus
+
+
+def fake_message(guild_id: int, message_id: int):
+    """ Just the attributes Image_Job reads from a discord.py Message """
+    return SimpleNamespace(
+        id=message_id,
+        guild=SimpleNamespace(id=guild_id, name='bench'),
+        channel=SimpleNamespace(id=2, name='general', category_id=None),
+        author=SimpleNamespace(id=3, name='bench', discriminator='0001'),
+        jump_url=f'https://discord.com/channels/{guild_id}/2/{message_id}',
+        created_at=datetime.utcnow())
+
+
+class Fake_Vision_Client():
+    """ Stands in for vision.ImageAnnotatorClient, every RPC takes latency seconds """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def batch_annotate_images(self, requests):
+        time.sleep(self.latency)
+
+        responses = []
+        for request in requests:
+            responses.append(SimpleNamespace(
+                error=SimpleNamespace(code=0, message=''),
+                text_annotations=[SimpleNamespace(description=words_for(request.image.content))]))
+
+        return SimpleNamespace(responses=responses)
+
+
+class Fake_Indices():
+    def __init__(self, es):
+        self.es = es
+
+    async def exists(self, index):
+        return index in self.es.indices_created
+
+    async def create(self, index, body=None):
+        self.es.indices_created.add(index)
+
+    async def exists_alias(self, name, index=None):
+        return name in self.es.aliases and (index is None or index in self.es.aliases[name])
+
+    async def get_alias(self, name):
+        return {index: {'aliases': {name: {}}} for index in self.es.aliases.get(name, ())}
+
+    async def put_alias(self, index, name):
+        self.es.aliases.setdefault(name, set()).add(index)
+
+    async def put_template(self, name, body):
+        pass
+
+    async def put_mapping(self, index, body):
+        pass
+
+    async def update_aliases(self, body):
+        for action in body['actions']:
+            kind, spec = next(iter(action.items()))
+            if kind == 'add':
+                self.es.aliases.setdefault(spec['alias'], set()).add(spec['index'])
+            elif kind == 'remove':
+                self.es.aliases.get(spec['alias'], set()).discard(spec['index'])
+            elif kind == 'remove_index':
+                self.es.indices_created.discard(spec['index'])
+                for indices in self.es.aliases.values():
+                    indices.discard(spec['index'])
+
+
+class Fake_Ilm():
+    async def put_lifecycle(self, policy, body):
+        pass
+
+
+class Fake_Elasticsearch():
+    """ In-memory stand-in for the parts of AsyncElasticsearch the bot uses.
+    Queries are evaluated by brute force, good enough to compare code paths.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.docs = {}
+        self.indices_created = set()
+        self.aliases = {}
+        self.indices = Fake_Indices(self)
+        self.ilm = Fake_Ilm()
+        self.next_id = 0
+
+    async def info(self):
+        return {'version': {'number': 'fake'}}
+
+    async def close(self):
+        pass
+
+    async def index(self, index, body):
+        await asyncio.sleep(self.latency)
+
+        return {'_id': self._store(body), 'result': 'created'}
+
+    async def bulk(self, body, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+        items = []
+        for action, source in zip(lines[::2], lines[1::2]):
+            items.append({'index': {'_id': self._store(source), 'status': 201}})
+
+        return {'errors': False, 'items': items}
+
+    async def search(self, index, body):
+        await asyncio.sleep(self.latency)
+
+        hits = []
+        for doc_id, source in self.docs.items():
+            matched, score = self._matches(doc_id, source, body.get('query', {'match_all': {}}))
+            if matched:
+                hits.append({'_index': 'fake', '_id': doc_id, '_score': score, '_source': source})
+
+        sort = body.get('sort')
+        if sort:
+            for hit in hits:
+                hit['sort'] = [hit['_score'] if field == '_score' else hit['_source'].get(field)
+                               for field, _ in self._sort_fields(sort)]
+            hits.sort(key=functools.cmp_to_key(
+                lambda a, b: self._compare(a['sort'], b['sort'], sort)))
+
+            if 'search_after' in body:
+                hits = [hit for hit in hits if self._compare(hit['sort'], body['search_after'], sort) > 0]
+
+        total = len(hits)
+        start = body.get('from', 0)
+        hits = hits[start:start + body.get('size', 10)]
+
+        highlight = body.get('highlight')
+        includes = body.get('_source')
+        for hit in hits:
+            if highlight:
+                text = hit['_source'].get('text', '')[:100]
+                hit['highlight'] = {'text': [f"{highlight['pre_tags'][0]}{text}{highlight['post_tags'][0]}"]}
+            if includes is False:
+                del hit['_source']
+            elif isinstance(includes, list):
+                hit['_source'] = {k: v for k, v in hit['_source'].items() if k in includes}
+
+        return {'took': 0, 'timed_out': False, '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+                'hits': {'total': {'value': total, 'relation': 'eq'}, 'max_score': None, 'hits': hits}}
+
+    def _store(self, source: dict) -> str:
+        self.next_id += 1
+        self.docs[str(self.next_id)] = source
+
+        return str(self.next_id)
+
+    def _sort_fields(self, sort: list) -> list:
+        fields = []
+        for item in sort:
+            if isinstance(item, str):
+                fields.append((item, 'desc' if item == '_score' else 'asc'))
+            else:
+                field, order = next(iter(item.items()))
+                fields.append((field, order['order'] if isinstance(order, dict) else order))
+
+        return fields
+
+    def _compare(self, a: list, b: list, sort: list) -> int:
+        for (field, order), x, y in zip(self._sort_fields(sort), a, b):
+            if x == y:
+                continue
+            if x is None or y is None:
+                result = 1 if x is None else -1
+            else:
+                result = -1 if x < y else 1
+            return -result if order == 'desc' else result
+
+        return 0
+
+    def _matches(self, doc_id: str, source: dict, query: dict) -> tuple:
+        kind, spec = next(iter(query.items()))
+
+        if kind == 'match_all':
+            return True, 1.0
+        elif kind == 'bool':
+            score = 0.0
+            for clause in spec.get('must', []) + spec.get('filter', []):
+                matched, clause_score = self._matches(doc_id, source, clause)
+                if not matched:
+                    return False, 0.0
+                score += clause_score
+            for clause in spec.get('must_not', []):
+                if self._matches(doc_id, source, clause)[0]:
+                    return False, 0.0
+            should = spec.get('should', [])
+            if should:
+                scores = [self._matches(doc_id, source, clause) for clause in should]
+                # Like Elasticsearch, should clauses are optional next to must or filter
+                required = 0 if spec.get('must') or spec.get('filter') else 1
+                required = self._minimum_should_match(spec.get('minimum_should_match', required), len(should))
+                if sum(m for m, _ in scores) < required:
+                    return False, 0.0
+                score += sum(s for m, s in scores if m)
+            return True, score
+        elif kind == 'ids':
+            return doc_id in spec['values'], 0.0
+        elif kind in ('term', 'terms'):
+            field, value = next(iter(spec.items()))
+            values = value if kind == 'terms' else [value.get('value') if isinstance(value, dict) else value]
+            return source.get(field) in values or str(source.get(field)) in map(str, values), 0.0
+        elif kind == 'range':
+            field, bounds = next(iter(spec.items()))
+            value = source.get(field)
+            if value is None:
+                return False, 0.0
+            checks = {'gt': value > bounds.get('gt', value - 1) if 'gt' in bounds else True,
+                      'gte': value >= bounds['gte'] if 'gte' in bounds else True,
+                      'lt': value < bounds['lt'] if 'lt' in bounds else True,
+                      'lte': value <= bounds['lte'] if 'lte' in bounds else True}
+            return all(checks.values()), 0.0
+        elif kind in ('match', 'match_phrase'):
+            field, value = next(iter(spec.items()))
+            options = value if isinstance(value, dict) else {}
+            value = options.get('query', value)
+            text = str(source.get(field.split('.')[0], '')).lower()
+            tokens = self._analyze(text, field)
+            wanted = self._analyze(str(value).lower(), field)
+            if kind == 'match_phrase':
+                n = len(wanted)
+                found = any(tokens[i:i + n] == wanted for i in range(len(tokens) - n + 1))
+                return found, float(found)
+            if 'fuzziness' in options:
+                prefix = options.get('prefix_length', 0)
+                found = [any(self._fuzzy_equal(w, t, prefix) for t in tokens) for w in wanted]
+            else:
+                token_set = set(tokens)
+                found = [w in token_set for w in wanted]
+            if options.get('operator') == 'and':
+                required = len(wanted)
+            else:
+                required = self._minimum_should_match(options.get('minimum_should_match', 1), len(wanted))
+            return sum(found) >= max(required, 1), float(sum(found))
+        else:
+            raise NotImplementedError(f'Fake Elasticsearch does not support {kind} queries')
+
+    def _analyze(self, text: str, field: str) -> list:
+        words = text.split()
+        if not field.endswith('.trigram'):
+            return words
+
+        return [word[i:i + 3] for word in words for i in range(len(word) - 2)]
+
+    def _fuzzy_equal(self, a: str, b: str, prefix: int) -> bool:
+        # AUTO fuzziness: exact up to 2 characters, one edit up to 5, two beyond
+        allowed = 0 if len(a) <= 2 else 1 if len(a) <= 5 else 2
+        if a[:prefix] != b[:prefix] or abs(len(a) - len(b)) > allowed:
+            return False
+
+        previous = list(range(len(b) + 1))
+        for i, x in enumerate(a, 1):
+            current = [i]
+            for j, y in enumerate(b, 1):
+                current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (x != y)))
+            previous = current
+
+        return previous[-1] <= allowed
+
+    def _minimum_should_match(self, value, clauses: int) -> int:
+        if isinstance(value, str) and value.endswith('%'):
+            return int(clauses * int(value[:-1]) / 100)
+
+        return int(value)
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def run_stage(name: str, func, items: list, concurrency: int) -> dict:
+    """ Call func on every item with at most concurrency calls in flight
+
+    Returns:
+        dict -- Throughput, latency percentiles and peak traced memory
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(item):
+        async with semaphore:
+            start = time.perf_counter()
+            await func(item)
+            latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    await asyncio.gather(*[one(item) for item in items])
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'stage': name,
+        'count': len(items),
+        'seconds': seconds,
+        'per_second': len(items) / seconds if seconds else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_mb': peak / 1e6
+    }
+
+
+def setup_environment(args) -> str:
+    """ Working directory with the files lib.py loads on import, pointing at the stand-ins """
+    workdir = tempfile.mkdtemp(prefix='ocr-bench-')
+
+    with open(os.path.join(SRC, 'config.json'), 'r') as f:
+        config = json.load(f)
+
+    # The tesseract backend doesn't need credentials to construct, it's swapped for the fake below.
+    # The OCR rate limit is off so the pipeline is measured, not the quota.
+    config.update({
+        'db-connect': True,
+        'ocr-backend': 'tesseract',
+        'ocr-cache-path': os.path.join(workdir, 'ocr_cache.db'),
+        'dedup-persist': False,
+        'log-level': 'WARNING',
+        'metrics-port': 0,
+        'ocr-rate-limit': 0
+    })
+
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(config, f)
+
+    with open(os.path.join(workdir, 'discord_secrets.json'), 'w') as f:
+        json.dump({'discord-token': '', 'owner-id': ''}, f)
+
+    with open(os.path.join(workdir, 'config.py'), 'w') as f:
+        f.write(f'es_host = {args.es_host or "localhost:9200"!r}\n')
+
+    os.mkdir(os.path.join(workdir, 'sql'))
+
+    return workdir
+
+
+async def serve_corpus(corpus: list, port: int):
+    """ Serve the corpus over HTTP like the Discord CDN would """
+    from aiohttp import web
+
+    async def handler(request):
+        return web.Response(body=corpus[int(request.match_info['i'])], content_type='image/png')
+
+    app = web.Application()
+    app.router.add_get('/attachments/{i}.png', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    return runner
+
+
+async def main(args) -> list:
+    import lib
+    from ocr import Vision_Backend
+
+    lib.ocr_backend = Vision_Backend(Fake_Vision_Client(args.vision_latency),
+                                     max_batch=lib.config['vision-batch-size'],
+                                     window=lib.config['vision-batch-window-ms'] / 1000,
+                                     max_bytes=lib.config['vision-batch-max-bytes'])
+    if not args.es_host:
+        lib.db.client = Fake_Elasticsearch(latency=args.es_latency)
+
+    await lib.setup()
+
+    print(f'[BENCH]: Generating {args.images * 2} synthetic images')
+    corpus = make_corpus(args.images * 2, seed=args.seed)
+    runner = await serve_corpus(corpus, args.port)
+
+    results = []
+    try:
+        # OCR alone, through the batching backend
+        results.append(await run_stage('detect_text', lib.detect_text,
+                                       corpus[:args.images], args.concurrency))
+
+        # The whole ingestion pipeline, download to OCR, with images it hasn't seen yet
+        async def save(i):
+            url = f'http://127.0.0.1:{args.port}/attachments/{i}.png'
+            await lib.save_image_text(url, fake_message(args.guild_id, i))
+        results.append(await run_stage('save_image_text', save,
+                                       list(range(args.images, args.images * 2)), args.concurrency))
+
+        docs = [lib.Attachment(timestamp=int(time.time() * 1000), author_id=3, author_username='bench#0001',
+                               channel='general', category_id=None, guild='bench', guild_id=args.guild_id,
+                               message_url=f'https://discord.com/channels/{args.guild_id}/2/{i}',
+                               url=f'http://127.0.0.1:{args.port}/attachments/{i}.png',
+                               text=words_for(content), hash=hashlib.md5(content).hexdigest(),
+                               filename=f'{i}.png')
+                for i, content in enumerate(corpus)]
+
+        results.append(await run_stage('save_attachment', lib.db.save_attachment,
+                                       docs, args.concurrency))
+
+        results.append(await run_stage('exists', lambda doc: lib.db.exists(str(args.guild_id), hash=doc.hash),
+                                       docs, args.concurrency))
+
+        rng = random.Random(args.seed)
+        phrases = [' '.join(rng.sample(WORDS, rng.randint(1, 2))) for _ in range(args.searches)]
+        results.append(await run_stage('search', lambda phrase: lib.search(args.guild_id, lib.Search_Query(phrase=phrase)),
+                                       phrases, args.concurrency))
+
+        # The default search, typo tolerant with the trigram subfield, with an OCR-like misread per phrase
+        typos = [phrase[:1] + phrase[2:] if len(phrase) > 3 else phrase for phrase in phrases]
+        results.append(await run_stage('search_fuzzy',
+                                       lambda phrase: lib.search(args.guild_id, lib.Search_Query(phrase=phrase, fuzzy=True)),
+                                       typos, args.concurrency))
+    finally:
+        await runner.cleanup()
+        await lib.shutdown()
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the OCR bot hot paths')
+    parser.add_argument('--images', type=int, default=100, help='images per ingestion stage')
+    parser.add_argument('--searches', type=int, default=200, help='number of search() calls')
+    parser.add_argument('--concurrency', type=int, default=32, help='calls in flight per stage')
+    parser.add_argument('--vision-latency', type=float, default=0.15, help='seconds per fake Vision RPC')
+    parser.add_argument('--es-latency', type=float, default=0.0, help='seconds per fake Elasticsearch call')
+    parser.add_argument('--es-host', default='', help='use a real Elasticsearch instead of the fake')
+    parser.add_argument('--guild-id', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8765, help='port for the fake CDN')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default='', help='also write the results to this file')
+    args = parser.parse_args()
+
+    workdir = setup_environment(args)
+    sys.path.insert(0, SRC)
+    sys.path.insert(0, workdir)
+    os.chdir(workdir)
+
+    try:
+        # lib creates loop bound objects on import, run on the same loop like bot.run does
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(main(args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'stage':<16}{'count':>7}{'per sec':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak MB':>10}")
+    for r in results:
+        print(f"{r['stage']:<16}{r['count']:>7}{r['per_second']:>10.1f}{r['p50_ms']:>10.1f}"
+              f"{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['peak_mb']:>10.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
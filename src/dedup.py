@@ -0,0 +1,230 @@
+import io
+
+from collections import OrderedDict
+from metrics import Counter
+from PIL import Image, ImageOps
+
+
+DEDUP_LOOKUPS = Counter('dedup_lookups_total', 'Dedup cache lookups by outcome', ['result'])
+
+
+def image_dhash(content: bytes, size=16) -> int:
+    """ Difference hash of an image, close for resized or recompressed copies.
+    Small hashes can't tell captions or screenshot text apart, so keep size large.
+
+    Arguments:
+        content {bytes} -- Raw image bytes
+
+    Keyword Arguments:
+        size {int} -- Hash is size*size bits (default: {16})
+
+    Returns:
+        int -- Perceptual hash, None if the image couldn't be decoded
+    """
+    try:
+        image = Image.open(io.BytesIO(content))
+        image.seek(0)
+        image = ImageOps.grayscale(image).resize((size + 1, size), Image.LANCZOS)
+    except Exception:
+        return None
+
+    pixels = list(image.getdata())
+
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+class BK_Tree():
+    """ Burkhard-Keller tree for finding hashes within a Hamming distance.
+    Removed values are only counted down and skipped, the tree is rebuilt once
+    more than half of its nodes are dead.
+    """
+
+    def __init__(self):
+        # Node: [value, count, {distance: child}]
+        self.root = None
+        self.live = 0
+        self.dead = 0
+
+    def add(self, value: int) -> None:
+        self.live += 1
+
+        if self.root is None:
+            self.root = [value, 1, {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                if node[1] == 0:
+                    self.dead -= 1
+                node[1] += 1
+                return
+
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, 1, {}]
+                return
+            node = child
+
+    def remove(self, value: int) -> None:
+        node = self.root
+        while node is not None:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                if node[1] > 0:
+                    node[1] -= 1
+                    self.live -= 1
+                    if node[1] == 0:
+                        self.dead += 1
+                break
+            node = node[2].get(distance)
+
+        if self.dead > self.live:
+            self._rebuild()
+
+    def find(self, value: int, max_distance: int) -> bool:
+        """ Check if any value within max_distance of the given one is in the tree
+
+        Arguments:
+            value {int} -- Hash to look up
+            max_distance {int} -- Largest Hamming distance that counts as a match
+
+        Returns:
+            bool -- True if a close enough value was found
+        """
+        if self.root is None:
+            return False
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+
+            if distance <= max_distance and node[1] > 0:
+                return True
+
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+
+        return False
+
+    def _rebuild(self) -> None:
+        values = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            values.extend([node[0]] * node[1])
+            stack.extend(node[2].values())
+
+        self.root = None
+        self.live = 0
+        self.dead = 0
+        for value in values:
+            self.add(value)
+
+
+class Dedup_Cache():
+    """ In-process record of the images already seen in each guild, keyed by
+    (guild_id, md5) with LRU eviction. If perceptual hashes are given, every
+    guild also gets a BK_Tree of them so resized or recompressed reposts are
+    caught too. They're opt-in, images that only differ in their text can hash
+    within a few bits of each other.
+    """
+
+    def __init__(self, capacity=100000, max_distance=0, sql_db=None):
+        self.capacity = capacity
+        self.max_distance = max_distance
+        self.sql_db = sql_db
+
+        self.entries = OrderedDict()
+        self.trees = {}
+
+        self.hits = 0
+        self.perceptual_hits = 0
+        self.misses = 0
+
+        if sql_db is not None:
+            for guild_id, hash, dhash in sql_db.get_image_hashes(capacity):
+                self._add(guild_id, hash, dhash)
+
+    def check(self, guild_id: str, hash: str, dhash: int) -> bool:
+        """ Check if the image has already been seen in the guild
+
+        Arguments:
+            guild_id {str} -- Discord guild ID
+            hash {str} -- MD5 hash of the image
+            dhash {int} -- Perceptual hash of the image, None to only compare MD5s
+
+        Returns:
+            bool -- True if it's a repost
+        """
+        key = (str(guild_id), hash)
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            DEDUP_LOOKUPS.inc(result='hit')
+            return True
+
+        tree = self.trees.get(str(guild_id))
+        if dhash is not None and tree is not None and tree.find(dhash, self.max_distance):
+            self.perceptual_hits += 1
+            DEDUP_LOOKUPS.inc(result='perceptual_hit')
+            return True
+
+        self.misses += 1
+        DEDUP_LOOKUPS.inc(result='miss')
+        return False
+
+    def add(self, guild_id: str, hash: str, dhash: int) -> None:
+        """ Remember an image, persisting it if a sqlite db was given
+
+        Arguments:
+            guild_id {str} -- Discord guild ID
+            hash {str} -- MD5 hash of the image
+            dhash {int} -- Perceptual hash of the image, can be None
+        """
+        if (str(guild_id), hash) in self.entries:
+            return
+
+        self._add(str(guild_id), hash, dhash)
+
+        if self.sql_db is not None:
+            self.sql_db.add_image_hash(guild_id, hash, dhash)
+
+    def _add(self, guild_id: str, hash: str, dhash: int) -> None:
+        self.entries[(guild_id, hash)] = dhash
+
+        if dhash is not None:
+            self.trees.setdefault(guild_id, BK_Tree()).add(dhash)
+
+        while len(self.entries) > self.capacity:
+            (old_guild_id, _), old_dhash = self.entries.popitem(last=False)
+            if old_dhash is not None:
+                self.trees[old_guild_id].remove(old_dhash)
+
+    def stats(self) -> dict:
+        """ Hit and miss counters for the stats command
+
+        Returns:
+            dict -- entries, exact hits, perceptual hits and misses
+        """
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'perceptual_hits': self.perceptual_hits,
+            'misses': self.misses
+        }
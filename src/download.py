@@ -0,0 +1,106 @@
+import aiohttp
+import asyncio
+import filetype
+import logging
+import time
+
+from metrics import Counter, Histogram
+
+
+log = logging.getLogger(__name__)
+
+DOWNLOAD_SECONDS = Histogram('download_seconds', 'Time to stream one image from the CDN')
+DOWNLOAD_BYTES = Counter('download_bytes_total', 'Bytes of images downloaded')
+DOWNLOAD_REJECTED = Counter('download_rejected_total', 'Downloads given up on', ['reason'])
+
+
+class Downloader():
+    """ Streams images from the Discord CDN over one pooled aiohttp session.
+    The type is sniffed from the first bytes and oversized files are dropped
+    as soon as they go over max_bytes, so rejected downloads stop early.
+    """
+
+    # filetype only looks at this many bytes
+    HEAD_SIZE = 262
+
+    def __init__(self, max_bytes=10000000, pool_size=20, timeout=60):
+        self.max_bytes = max_bytes
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = None
+
+        self.downloaded_bytes = 0
+        self.rejected = 0
+
+    async def download(self, url: str) -> tuple:
+        """ Download an image
+
+        Arguments:
+            url {str} -- CDN URL of the image
+
+        Returns:
+            tuple -- (the whole image, its sniffed extension e.g. png),
+                     (None, None) if it wasn't an image, was too large or failed
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        start = time.perf_counter()
+        async with self.session.get(url) as r:
+            if r.status != 200:
+                log.warning('url=%s status=%d', url, r.status)
+                DOWNLOAD_REJECTED.inc(reason='status')
+                return None, None
+
+            if r.content_length is not None and r.content_length > self.max_bytes:
+                log.info('url=%s too large size=%d', url, r.content_length)
+                DOWNLOAD_REJECTED.inc(reason='size')
+                self.rejected += 1
+                return None, None
+
+            try:
+                head = await r.content.readexactly(self.HEAD_SIZE)
+            except asyncio.IncompleteReadError as e:
+                head = e.partial
+
+            # Return if it's not an image
+            kind = filetype.guess(head)
+            if kind is None or 'image' not in kind.mime:
+                log.info('url=%s not an image', url)
+                DOWNLOAD_REJECTED.inc(reason='type')
+                self.rejected += 1
+                return None, None
+
+            chunks = [head]
+            size = len(head)
+            async for chunk in r.content.iter_chunked(65536):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    log.info('url=%s too large size>%d', url, self.max_bytes)
+                    DOWNLOAD_REJECTED.inc(reason='size')
+                    self.rejected += 1
+                    return None, None
+                chunks.append(chunk)
+
+        self.downloaded_bytes += size
+        DOWNLOAD_BYTES.inc(size)
+        DOWNLOAD_SECONDS.observe(time.perf_counter() - start)
+
+        return b''.join(chunks), kind.extension
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+    def stats(self) -> dict:
+        """ Counters for the stats command
+
+        Returns:
+            dict -- bytes downloaded and number of rejected downloads
+        """
+        return {
+            'bytes': self.downloaded_bytes,
+            'rejected': self.rejected
+        }
@@ -1,68 +1,362 @@
-from elasticsearch import Elasticsearch, exceptions
-from elasticsearch_dsl import connections, Search, Document, Index, Text, Date, Long, Q, analyzer, tokenizer
+import asyncio
+import logging
+import re
+import time
+
+from elasticsearch import AsyncElasticsearch, exceptions
+from elasticsearch.helpers import async_streaming_bulk
+from elasticsearch_dsl import Search, Document, Index, Text, Date, Long, Keyword, Q, analyzer, tokenizer, token_filter
+from elasticsearch_dsl.response import Response
+from metrics import Counter, Gauge, Histogram
 from config import es_host
 
 
+log = logging.getLogger(__name__)
+
+ES_REQUEST_SECONDS = Histogram('es_request_seconds', 'Elasticsearch request latency', ['operation'])
+ES_BULK_DOCUMENTS = Counter('es_bulk_documents_total', 'Attachments written with the bulk API', ['result'])
+ES_BULK_PENDING = Gauge('es_bulk_pending', 'Attachments waiting in the bulk buffer')
+
+
 standard = analyzer('standard',
                     tokenizer=tokenizer('standard'),
                     filter=['lowercase']
                     )
 
+# Overlapping 3 character chunks of every word, so a word with a misread
+# character still shares most of its trigrams with the correct spelling
+trigram = analyzer('trigram',
+                   tokenizer=tokenizer('standard'),
+                   filter=['lowercase', token_filter('trigram_filter', type='ngram', min_gram=3, max_gram=3)]
+                   )
+
+
+# Bump whenever the Attachment mapping changes, connect() starts a new rollover series and reindexes into it
+MAPPING_VERSION = 3
+
 
 class Attachment(Document):
     timestamp = Date()
-    author_id = Text()
-    author_username = Text()
-    channel = Text()
-    category_id = Text()
-    guild = Text()
-    guild_id = Text()
-    url = Text()
-    message_url = Text()
-    filename = Text()
-    text = Text(analyzer=standard)
-    hash = Text()
+    author_id = Long()
+    author_username = Keyword(index=False)
+    channel = Keyword(index=False)
+    channel_id = Long()
+    category_id = Long()
+    guild = Keyword(index=False)
+    guild_id = Long()
+    url = Keyword(index=False)
+    message_url = Keyword(index=False)
+    filename = Keyword(index=False)
+    file_type = Keyword()
+    text = Text(analyzer=standard, fields={'trigram': Text(analyzer=trigram)})
+    hash = Keyword()
+    # Series a document was reindexed into, hides the copy while the original is still searched
+    migrated_to = Keyword()
 
 
 class Elastic_Database():
-    def __init__(self, index_name: str):
-        connections.create_connection(hosts=[es_host], timeout=20)
-        self.create_index(index_name)
+    """ Every Elasticsearch call goes through one AsyncElasticsearch client so
+    requests share a pool of keep-alive connections and never block the event loop.
+
+    Attachments are written through a write alias (index_name-write) to a series
+    of indices, index_name-vN-000001, -000002, ... for the current MAPPING_VERSION.
+    An ILM policy rolls the series over once the newest index gets too big or
+    old, then force merges and shrinks indices that are no longer written to.
+    Searches go through the read alias, index_name, which covers the whole series.
+    """
+
+    def __init__(self, index_name: str, pool_size=10, shards=1, rollover_max_size='20gb',
+                 rollover_max_age='30d', warm_after='7d', delete_after=''):
+        self.client = AsyncElasticsearch(hosts=[es_host], timeout=20,
+                                         maxsize=pool_size, http_compress=True)
         self.index = index_name
+        self.write_index = f'{index_name}-write'
+        self.read_index = index_name
+        # Unique field to end every sort with, see connect()
+        self.tiebreaker = 'url'
+        self.series = f'{index_name}-v{MAPPING_VERSION}'
+        self.policy = f'{index_name}-policy'
+        self.migration = None
+        # Old indices are searched alongside the series until migrate() swaps the read alias
+        self.migrating = False
+        self.write_listeners = []
+
+        self.shards = shards
+        self.rollover_max_size = rollover_max_size
+        self.rollover_max_age = rollover_max_age
+        self.warm_after = warm_after
+        self.delete_after = delete_after
 
-    def create_index(self, index_name: str) -> None:
-        """ Create the given index
+    async def connect(self, migrate=True) -> None:
+        """ Check Elasticsearch is reachable, set up the lifecycle policy, template and
+        first index of the series if they're missing, and start migrating older indices
+
+        Keyword Arguments:
+            migrate {bool} -- Run the migration here, otherwise only wait for the process
+                              that does to finish it (default: {True})
+        """
+        await self.client.info()
+
+        # A concrete index from before aliases were used holds the read alias' name until it's migrated
+        legacy = await self.client.indices.exists(index=self.index) and \
+            not await self.client.indices.exists_alias(name=self.index)
+
+        await self.put_lifecycle_policy()
+        await self.put_template(read_alias=not legacy)
+        await self.bootstrap(read_alias=not legacy)
+        await self.put_mapping()
+
+        old_indices = await self.get_old_indices()
+
+        if not old_indices:
+            return
+
+        # The read alias already covers old and new indices, except for a legacy concrete index.
+        # Its url is an analysed text field that can't be sorted on, _id can be in both mappings.
+        if legacy:
+            self.read_index = f'{self.index},{self.series}-*'
+            self.tiebreaker = '_id'
+        self.migrating = True
+        if migrate:
+            self.migration = asyncio.ensure_future(self.migrate(old_indices))
+        else:
+            self.migration = asyncio.ensure_future(self.wait_for_migration())
+
+    def add_write_listener(self, func) -> None:
+        """ Call func(guild_ids) after attachments have been written, e.g. to invalidate caches
+
+        Arguments:
+            func {callable} -- Takes the set of guild IDs (as str) that were written to
+        """
+        self.write_listeners.append(func)
+
+    def _notify_write(self, attachments: list) -> None:
+        guild_ids = {str(attachment.guild_id) for attachment in attachments}
+
+        for func in self.write_listeners:
+            func(guild_ids)
+
+    async def close(self) -> None:
+        if self.migration is not None:
+            self.migration.cancel()
+
+        await self.client.close()
+
+    def in_series(self, index_name: str) -> bool:
+        """ Check if an index belongs to the rollover series for the current mapping
 
         Arguments:
-            index_name {str} -- Name of the index to create
+            index_name {str} -- Name of the index, ILM prefixes shrunk indices with shrink-
+
+        Returns:
+            bool -- True if it's one of the current rollover indices
         """
-        i = Index(index_name)
+        return re.fullmatch(rf'(shrink-)?{re.escape(self.series)}-\d+', index_name) is not None
+
+    async def put_lifecycle_policy(self) -> None:
+        """ Create or update the ILM policy: roll over in the hot phase, then force
+        merge to one segment and shrink to one shard once rolled over indices go warm
+        """
+        phases = {
+            'hot': {
+                'actions': {
+                    'rollover': {'max_size': self.rollover_max_size, 'max_age': self.rollover_max_age},
+                    'set_priority': {'priority': 100}
+                }
+            },
+            'warm': {
+                'min_age': self.warm_after,
+                'actions': {
+                    'forcemerge': {'max_num_segments': 1},
+                    'shrink': {'number_of_shards': 1},
+                    'set_priority': {'priority': 50}
+                }
+            }
+        }
+
+        if self.delete_after:
+            phases['delete'] = {'min_age': self.delete_after, 'actions': {'delete': {}}}
 
-        doc = Attachment()
+        await self.client.ilm.put_lifecycle(policy=self.policy, body={'policy': {'phases': phases}})
+
+    async def put_template(self, read_alias=True) -> None:
+        """ Create or update the template every index in the series is created from
+
+        Keyword Arguments:
+            read_alias {bool} -- Add new indices to the read alias (default: {True})
+        """
+        i = Index(self.series)
+        i.document(Attachment)
+        body = i.to_dict()
+
+        body['index_patterns'] = [f'{self.series}-*']
+        body.setdefault('settings', {}).update({
+            'number_of_shards': self.shards,
+            'index.lifecycle.name': self.policy,
+            'index.lifecycle.rollover_alias': self.write_index
+        })
+
+        if read_alias:
+            body['aliases'] = {self.index: {}}
+
+        await self.client.indices.put_template(name=self.series, body=body)
+
+    async def put_mapping(self) -> None:
+        """ Add fields that are new to the mapping to the existing indices of the series,
+        only changes to existing fields need a MAPPING_VERSION bump and a reindex
+        """
+        await self.client.indices.put_mapping(index=f'{self.series}-*',
+                                              body=Attachment._doc_type.mapping.to_dict())
+
+    async def bootstrap(self, read_alias=True) -> None:
+        """ Create the first index of the series and point the write alias at it,
+        unless the write alias is already on the current series
+
+        Keyword Arguments:
+            read_alias {bool} -- Also add the index to the read alias (default: {True})
+        """
+        current = {}
+        if await self.client.indices.exists_alias(name=self.write_index):
+            current = await self.client.indices.get_alias(name=self.write_index)
+            if any(self.in_series(index) for index in current):
+                return
+
+        first = f'{self.series}-000001'
+        if not await self.client.indices.exists(index=first):
+            await self.client.indices.create(index=first)
+
+        # Move the write alias off an older series in the same request
+        actions = [{'add': {'index': first, 'alias': self.write_index, 'is_write_index': True}}]
+        for index in current:
+            actions.append({'remove': {'index': index, 'alias': self.write_index}})
+        if read_alias:
+            actions.append({'add': {'index': first, 'alias': self.index}})
+
+        await self.client.indices.update_aliases(body={'actions': actions})
+
+    async def get_old_indices(self) -> list:
+        """ Indices outside the current rollover series: either a concrete index named
+        like the alias, from before the alias existed, or older indices behind the alias
+
+        Returns:
+            list -- Index names
+        """
+        if await self.client.indices.exists_alias(name=self.index):
+            aliased = await self.client.indices.get_alias(name=self.index)
+            return [index for index in aliased if not self.in_series(index)]
+        elif await self.client.indices.exists(index=self.index):
+            return [self.index]
+        else:
+            return []
+
+    async def migrate(self, old_indices: list) -> None:
+        """ Reindex the old indices through the write alias then atomically delete them
+        and point the read alias at the new series, searches keep working the whole time.
+        Older series can't stay around, their ILM rollover alias now belongs to this one.
+        Copies are tagged with migrated_to and left out of searches until the swap, so
+        each document is only found once.
+
+        Arguments:
+            old_indices {list} -- Index names to copy from
+        """
+        try:
+            for index in old_indices:
+                log.info('reindexing source=%s dest=%s', index, self.write_index)
+                task = await self.client.reindex(body={
+                    'conflicts': 'proceed',
+                    'source': {'index': index},
+                    'dest': {'index': self.write_index, 'op_type': 'create'},
+                    'script': {'source': 'ctx._source.migrated_to = params.series',
+                               'params': {'series': self.series}}
+                }, wait_for_completion=False)
+
+                while True:
+                    status = await self.client.tasks.get(task_id=task['task'])
+                    if status['completed']:
+                        break
+                    await asyncio.sleep(5)
+
+                await self.check_reindex(index, status)
+
+            # A concrete index has to go before an alias can take its name
+            actions = [{'remove_index': {'index': index}} for index in old_indices]
+            actions.append({'add': {'index': f'{self.series}-*', 'alias': self.index}})
+
+            await self.client.indices.update_aliases(body={'actions': actions})
+
+            # Indices rolled over from now on join the read alias by themselves
+            if self.index in old_indices:
+                await self.put_template(read_alias=True)
+
+            self.use_new_series()
+        except Exception as e:
+            # The old indices and read alias are left alone, nothing is deleted
+            log.error('migration to %s failed, searching both until restart: %r', self.series, e)
+            return
+
+        log.info('migrated to %s', self.series)
+
+    async def wait_for_migration(self, interval=60) -> None:
+        """ Poll until the process running the migration has deleted the old indices,
+        then search only the new series like it does
+
+        Keyword Arguments:
+            interval {int} -- Seconds between checks (default: {60})
+        """
+        while True:
+            await asyncio.sleep(interval)
 
-        if not i.exists():
             try:
-                i.document(Attachment)
-                i.create()
+                if not await self.get_old_indices():
+                    break
             except Exception as e:
-                print(e)
-                return
+                log.warning('checking migration to %s failed, trying again: %r', self.series, e)
+
+        self.use_new_series()
+        log.info('migration to %s finished by another process', self.series)
+
+    def use_new_series(self) -> None:
+        """ Search through the read alias again once nothing is left to migrate """
+        self.read_index = self.index
+        self.tiebreaker = 'url'
+        self.migrating = False
 
-        self.index = i
+    async def check_reindex(self, index: str, status: dict) -> None:
+        """ Make sure a finished reindex task copied every document of its source,
+        the source is deleted afterwards so anything it missed would be lost
 
-    def delete_index(self, index_name="") -> None:
+        Arguments:
+            index {str} -- Source index of the task
+            status {dict} -- Tasks API response for the completed task
+
+        Raises:
+            RuntimeError: If the task failed or copied fewer documents than the source has
+        """
+        if status.get('error'):
+            raise RuntimeError(f'reindex of {index} failed: {status["error"]}')
+
+        response = status.get('response', {})
+        if response.get('failures'):
+            raise RuntimeError(f'reindex of {index} had failures={len(response["failures"])}, '
+                               f'first: {response["failures"][0]}')
+
+        # Conflicts are documents that were already copied, e.g. by an earlier run
+        copied = response.get('created', 0) + response.get('version_conflicts', 0)
+        count = (await self.client.count(index=index))['count']
+        if copied < count:
+            raise RuntimeError(f'reindex of {index} copied={copied} of docs={count}')
+
+        log.info('reindexed source=%s docs=%d', index, count)
+
+    async def delete_index(self, index_name="") -> None:
         """ Delete the given index
 
         Keyword Arguments:
-            index_name {str} -- Name of the index to delete (default: {""})
+            index_name {str} -- Name of the index to delete, every index in the series if empty (default: {""})
         """
-        if index_name:
-            i = Index(index_name)
-            i.delete()
-        else:
-            self.index_name.delete()
+        await self.client.indices.delete(index=index_name if index_name else f'{self.series}-*')
 
-    def save_attachment(self, attachment: Attachment, index_name="") -> None:
+    async def save_attachment(self, attachment: Attachment, index_name="") -> None:
         """ Save the given Attachment to the given index
 
         Arguments:
@@ -71,12 +365,69 @@ class Elastic_Database():
         Keyword Arguments:
             index_name {str} -- Name of the index to save the attachment to (default: {""})
         """
-        if index_name:
-            attachment.save(index=index_name)
-        else:
-            attachment.save(index=self.index)
+        start = time.perf_counter()
+        await self.client.index(index=index_name if index_name else self.write_index,
+                                body=attachment.to_dict())
+        ES_REQUEST_SECONDS.observe(time.perf_counter() - start, operation='index')
+
+        self._notify_write([attachment])
+
+    async def save_attachments(self, attachments: list, index_name="") -> list:
+        """ Save the given Attachments to the given index in a single bulk request
+
+        Arguments:
+            attachments {list} -- Attachments derived from the original message and images
+
+        Keyword Arguments:
+            index_name {str} -- Name of the index to save the attachments to (default: {""})
+
+        Returns:
+            list -- (attachment, status) for every attachment that failed to save
+        """
+        index = index_name if index_name else self.write_index
 
-    def exists(self, guild_id: str, es_id="", hash="") -> bool:
+        actions = []
+        for attachment in attachments:
+            action = attachment.to_dict(include_meta=True)
+            action['_index'] = index
+            actions.append(action)
+
+        failed = []
+        i = 0
+        start = time.perf_counter()
+        async for ok, item in async_streaming_bulk(self.client, actions,
+                                                   chunk_size=len(actions) or 1,
+                                                   raise_on_error=False, raise_on_exception=False):
+            if not ok:
+                failed.append((attachments[i], item['index'].get('status')))
+            i += 1
+        ES_REQUEST_SECONDS.observe(time.perf_counter() - start, operation='bulk')
+
+        if len(failed) < len(attachments):
+            self._notify_write(attachments)
+
+        return failed
+
+    async def search(self, search: Search) -> Response:
+        """ Execute an elasticsearch_dsl Search against the index
+
+        Arguments:
+            search {Search} -- Query to run
+
+        Returns:
+            Response -- elasticsearch_dsl response, hits can be used like Documents
+        """
+        # Only the originals of documents that are being copied into the series
+        if self.migrating:
+            search = search.exclude('term', migrated_to=self.series)
+
+        start = time.perf_counter()
+        raw = await self.client.search(index=self.read_index, body=search.to_dict())
+        ES_REQUEST_SECONDS.observe(time.perf_counter() - start, operation='search')
+
+        return Response(search, raw)
+
+    async def exists(self, guild_id: str, es_id="", hash="") -> bool:
         """ Check if the given attachment exists in the give
         Elasticsearch index
 
@@ -90,29 +441,30 @@ class Elastic_Database():
         Returns:
             bool -- True if already indexed, False otherwise
         """
-        search = Search(index=self.index)
+        search = Search()
 
+        # Filter context, no scoring needed for an existence check
         if es_id and hash:
             return False
         elif hash:
-            q = Q('bool', must=[Q('match', hash=hash),
-                                Q('match', guild_id=guild_id)])
+            q = Q('bool', filter=[Q('term', hash=hash),
+                                  Q('term', guild_id=int(guild_id))])
         elif es_id:
-            q = Q('bool', must=[Q('match', id=es_id),
-                                Q('match', guild_id=guild_id)])
+            q = Q('bool', filter=[Q('ids', values=[es_id]),
+                                  Q('term', guild_id=int(guild_id))])
         else:
             return False
 
-        s = search.query(q)
+        s = search.query(q).source(False)[:1]
 
-        res = s.execute()
+        res = await self.search(s)
 
         if len(res.hits) > 0:
             return True
         else:
             return False
 
-    def get_jump_url_by_id(self, es_id: str) -> str:
+    async def get_jump_url_by_id(self, es_id: str) -> str:
         """ Get the URL that will jump to the message in the Discord client
 
         Arguments:
@@ -121,12 +473,153 @@ class Elastic_Database():
         Returns:
             str -- Jump URL
         """
-        q = Q('match', _id=es_id)
+        q = Q('ids', values=[es_id])
 
-        search = Search(index=self.index)
-        s = search.query(q)
+        search = Search()
+        s = search.query(q).source(['message_url'])[:1]
 
-        res = s.execute()
+        res = await self.search(s)
 
         if len(res.hits) > 0:
             return res.hits[0].message_url
+
+
+class Bulk_Buffer():
+    """ Accumulates Attachments and writes them with the _bulk API once max_docs
+    are waiting or every flush_interval seconds. Attachments rejected with a
+    retryable status (429, 5xx or a connection error) are retried with backoff.
+
+    add() returns a future per attachment that is set to True once
+    Elasticsearch has acked it, or False if it was given up on.
+    """
+
+    def __init__(self, db: Elastic_Database, index_name="", max_docs=500, flush_interval=2.0, max_retries=3):
+        self.db = db
+        self.index_name = index_name
+        self.max_docs = max_docs
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+
+        # (attachment, future) pairs
+        self.pending = []
+        self.lock = None
+        self.task = None
+
+        self.flushes = 0
+        self.saved = 0
+        self.failed = 0
+
+        ES_BULK_PENDING.set_function(lambda: len(self.pending))
+
+    async def add(self, attachments: list) -> list:
+        """ Queue Attachments to be saved, flushing straight away if the buffer is full
+
+        Arguments:
+            attachments {list} -- Attachments to save
+
+        Returns:
+            list -- One future per attachment, True once it's saved, False if it failed
+        """
+        if self.task is None:
+            self.lock = asyncio.Lock()
+            self.task = asyncio.ensure_future(self._flush_loop())
+
+        loop = asyncio.get_event_loop()
+        futures = [loop.create_future() for _ in attachments]
+        self.pending.extend(zip(attachments, futures))
+
+        if len(self.pending) >= self.max_docs:
+            await self.flush()
+
+        return futures
+
+    async def flush(self) -> None:
+        """ Write everything that is waiting in the buffer """
+        if self.lock is None:
+            return
+
+        async with self.lock:
+            while self.pending:
+                batch = self.pending[:self.max_docs]
+                self.pending = self.pending[self.max_docs:]
+                await self._write(batch)
+
+    async def close(self) -> None:
+        """ Stop the periodic flush and write whatever is left """
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+        await self.flush()
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error('bulk flush failed: %r', e)
+
+    async def _write(self, batch: list) -> None:
+        self.flushes += 1
+        futures = {id(attachment): future for attachment, future in batch}
+        batch = [attachment for attachment, _ in batch]
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                failed = await self.db.save_attachments(batch, self.index_name)
+            except Exception as e:
+                log.error('bulk request failed docs=%d: %r', len(batch), e)
+                failed = [(attachment, None) for attachment in batch]
+
+            retry = [attachment for attachment, status in failed
+                     if not isinstance(status, int) or status == 429 or status >= 500]
+
+            failed_ids = {id(attachment) for attachment, _ in failed}
+            retry_ids = {id(attachment) for attachment in retry}
+            for attachment in batch:
+                if id(attachment) not in failed_ids:
+                    _resolve(futures[id(attachment)], True)
+                elif id(attachment) not in retry_ids:
+                    _resolve(futures[id(attachment)], False)
+
+            self.saved += len(batch) - len(failed)
+            self.failed += len(failed) - len(retry)
+            ES_BULK_DOCUMENTS.inc(len(batch) - len(failed), result='saved')
+            ES_BULK_DOCUMENTS.inc(len(failed) - len(retry), result='failed')
+
+            if not retry:
+                return
+
+            if attempt < self.max_retries:
+                log.warning('retrying docs=%d attempt=%d', len(retry), attempt + 1)
+                ES_BULK_DOCUMENTS.inc(len(retry), result='retried')
+                await asyncio.sleep(2 ** attempt)
+
+            batch = retry
+
+        log.error('gave up on docs=%d', len(batch))
+        self.failed += len(batch)
+        ES_BULK_DOCUMENTS.inc(len(batch), result='failed')
+
+        for attachment in batch:
+            _resolve(futures[id(attachment)], False)
+
+    def stats(self) -> dict:
+        """ Counters for the stats command
+
+        Returns:
+            dict -- pending, saved, failed and number of flushes
+        """
+        return {
+            'pending': len(self.pending),
+            'saved': self.saved,
+            'failed': self.failed,
+            'flushes': self.flushes
+        }
+
+
+def _resolve(future: asyncio.Future, saved: bool) -> None:
+    # The caller may have stopped waiting for it
+    if not future.done():
+        future.set_result(saved)
@@ -0,0 +1,185 @@
+import json
+import sqlite3
+import time
+
+from metrics import Gauge
+from sql import Async_Sqlite
+
+
+JOB_QUEUE_DEPTH = Gauge('job_queue_depth', 'Image jobs waiting in the shared queue, as of the last claim')
+
+
+class Job_Queue():
+    """ Image jobs handed from the gateway processes to the ingestion workers
+    through a sqlite file, so any number of processes on the host can share it.
+
+    Workers claim jobs instead of removing them. A claimed job that isn't acked
+    within claim_timeout seconds, e.g. because its worker died, can be claimed
+    again, up to max_attempts times.
+
+    Jobs are claimed round robin across guilds, oldest first within each guild,
+    so a raid in one guild can't fill every worker while the others wait.
+    """
+
+    def __init__(self, path: str, claim_timeout=300, max_attempts=3):
+        self.claim_timeout = claim_timeout
+        self.max_attempts = max_attempts
+        self.db = Async_Sqlite(path)
+        self.db.run_sync(self._create_table)
+
+        self.enqueued = 0
+        self.claimed = 0
+        self.acked = 0
+
+    def _create_table(self, connection: sqlite3.Connection) -> None:
+        sql_command = """
+        CREATE TABLE IF NOT EXISTS image_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        payload TEXT NOT NULL,
+        claimed_at REAL,
+        worker VARCHAR(100),
+        attempts INTEGER NOT NULL DEFAULT 0
+        );
+        """
+        connection.execute(sql_command)
+
+        # Queues from before jobs were claimed per guild, their jobs share one turn
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(image_jobs);")]
+        if 'guild_id' not in columns:
+            connection.execute("ALTER TABLE image_jobs ADD COLUMN guild_id VARCHAR(30);")
+
+        sql_command = """
+        CREATE INDEX IF NOT EXISTS image_jobs_claimed_at ON image_jobs (claimed_at);
+        """
+        connection.execute(sql_command)
+
+        sql_command = """
+        CREATE INDEX IF NOT EXISTS image_jobs_guild_id ON image_jobs (guild_id, id);
+        """
+        connection.execute(sql_command)
+
+        # Last time a worker indexed attachments for each guild, polled by the gateways to drop cached searches
+        sql_command = """
+        CREATE TABLE IF NOT EXISTS guild_writes (
+        guild_id VARCHAR(30) NOT NULL PRIMARY KEY,
+        written_at REAL NOT NULL
+        );
+        """
+        connection.execute(sql_command)
+        connection.commit()
+
+    def put(self, payloads: list) -> None:
+        """ Queue jobs, they're committed together with any others made in the next few milliseconds
+
+        Arguments:
+            payloads {list} -- JSON serialisable dicts, one per job, with the job's guild_id
+        """
+        sql_command = """
+        INSERT INTO image_jobs (guild_id, payload) VALUES (?, ?);
+        """
+        for payload in payloads:
+            self.db.write(sql_command, (str(payload['guild_id']), json.dumps(payload)))
+
+        self.enqueued += len(payloads)
+
+    async def claim(self, limit: int, worker: str) -> list:
+        """ Claim jobs that aren't being worked on, taking turns between guilds
+
+        Arguments:
+            limit {int} -- Most jobs to claim
+            worker {str} -- Name of the claiming worker, for debugging
+
+        Returns:
+            list -- (job ID, payload dict) pairs
+        """
+        if limit <= 0:
+            return []
+
+        jobs, depth = await self.db.run(self._claim, limit, worker, time.time())
+        JOB_QUEUE_DEPTH.set(depth)
+        self.claimed += len(jobs)
+
+        return jobs
+
+    def _claim(self, connection: sqlite3.Connection, limit: int, worker: str, now: float) -> tuple:
+        # Commit any batched writes first so the IMMEDIATE transaction can start
+        if connection.in_transaction:
+            connection.commit()
+
+        # Take the write lock before reading so two workers can't claim the same rows
+        connection.execute("BEGIN IMMEDIATE;")
+        try:
+            connection.execute("DELETE FROM image_jobs WHERE attempts >= ? AND claimed_at < ?;",
+                               (self.max_attempts, now - self.claim_timeout))
+
+            # Every guild's oldest job, then every guild's second oldest, ...
+            rows = connection.execute("""
+            SELECT id, payload FROM (
+                SELECT id, payload, ROW_NUMBER() OVER (PARTITION BY guild_id ORDER BY id) AS turn
+                FROM image_jobs
+                WHERE claimed_at IS NULL OR claimed_at < ?
+            )
+            ORDER BY turn, id LIMIT ?;
+            """, (now - self.claim_timeout, limit)).fetchall()
+
+            connection.executemany("""
+            UPDATE image_jobs SET claimed_at = ?, worker = ?, attempts = attempts + 1 WHERE id = ?;
+            """, [(now, worker, job_id) for job_id, _ in rows])
+
+            depth = connection.execute(
+                "SELECT COUNT(*) FROM image_jobs WHERE claimed_at IS NULL;").fetchone()[0]
+
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+        return [(job_id, json.loads(payload)) for job_id, payload in rows], depth
+
+    def ack(self, job_id: int) -> None:
+        """ Remove a finished job, whether it was indexed or dropped
+
+        Arguments:
+            job_id {int} -- ID returned by claim()
+        """
+        self.db.write("DELETE FROM image_jobs WHERE id = ?;", (job_id,))
+        self.acked += 1
+
+    def mark_written(self, guild_ids: set) -> None:
+        """ Record that attachments were just indexed for the guilds
+
+        Arguments:
+            guild_ids {set} -- Discord guild IDs
+        """
+        now = time.time()
+        for guild_id in guild_ids:
+            self.db.write("INSERT OR REPLACE INTO guild_writes (guild_id, written_at) VALUES (?, ?);",
+                          (str(guild_id), now))
+
+    async def written_since(self, since: float) -> list:
+        """ Guilds that had attachments indexed since the given time
+
+        Arguments:
+            since {float} -- Unix timestamp
+
+        Returns:
+            list -- Discord guild IDs
+        """
+        rows = await self.db.fetchall("SELECT guild_id FROM guild_writes WHERE written_at >= ?;", (since,))
+
+        return [guild_id for guild_id, in rows]
+
+    async def close(self) -> None:
+        await self.db.close()
+
+    def stats(self) -> dict:
+        """ Counters for the stats command
+
+        Returns:
+            dict -- jobs enqueued, claimed and acked by this process
+        """
+        return {
+            'enqueued': self.enqueued,
+            'claimed': self.claimed,
+            'acked': self.acked
+        }
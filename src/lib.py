@@ -1,40 +1,119 @@
 from __future__ import annotations
 
-import io
-import requests
+import asyncio
+import functools
+import logging
+import os
 import time
-import filetype
 import json
-import re
 
-from google.cloud import vision
-from elasticsearch_dsl import Search, Document, Index, Text, Long, Q
-from discord import Embed
+from elasticsearch_dsl import Search, Q
+from discord import Embed, Object, Forbidden
+from discord.utils import escape_markdown
 from hashlib import md5
-from es_db import Elastic_Database, Attachment
+from es_db import Elastic_Database, Attachment, Bulk_Buffer
 from sql import Sqlite3_db
+from pipeline import Ingestion_Pipeline, Image_Job
+from ocr import create_backend
+from dedup import Dedup_Cache, image_dhash
+from ocr_cache import OCR_Cache
+from download import Downloader
+from rate_limit import Fair_Scheduler
+from search_cache import Search_Cache
+from search_query import FILE_TYPES, Search_Query, parse_search
+from job_queue import Job_Queue
+from preprocess import get_process_pool, close_process_pool, needs_shrinking, shrink_image
+from metrics import Metrics_Server, setup_logging
 from discord.ext import menus
 
 
-class MySource(menus.ListPageSource):
-    def __init__(self, data):
-        super().__init__(data['fields_data'], per_page=5)
-        self.search_phrase = data['search_phrase']
+class MySource(menus.PageSource):
+    """ Search results fetched one page at a time, only when the user navigates to
+    a page that hasn't been fetched yet. The next page continues from the last one
+    with search_after, a jump further ahead asks for just that page with from.
+    """
+
+    def __init__(self, guild_id: str, query: Search_Query, per_page=5):
+        self.guild_id = guild_id
+        self.query = query
+        self.per_page = per_page
+
+        # page number -> results, and the search_after to continue from after it
+        self.pages = {}
+        self.cursors = {}
+        self.total = 0
+
+    async def prepare(self):
+        await self.fetch_page(0)
+
+    async def fetch_page(self, page_number: int) -> list:
+        """ Fetch one page of results, only the first one counts the total
+
+        Arguments:
+            page_number {int} -- Page to fetch, from 0
+
+        Returns:
+            list -- Results on the page
+        """
+        first = page_number == 0
+        previous = self.cursors.get(page_number - 1)
+
+        results, total, search_after = await search(self.guild_id, self.query,
+                                                    size=self.per_page,
+                                                    search_after=previous,
+                                                    offset=0 if first or previous else page_number * self.per_page,
+                                                    track_total=first)
+        if first:
+            self.total = total
+
+        self.pages[page_number] = results
+        if search_after:
+            self.cursors[page_number] = search_after
+
+        return results
+
+    def is_paginating(self):
+        return self.total > self.per_page
+
+    def get_max_pages(self):
+        # Pages past the result window can't be jumped to with from
+        return max(1, -(-min(self.total, MAX_RESULT_WINDOW) // self.per_page))
+
+    async def get_page(self, page_number):
+        if page_number not in self.pages:
+            await self.fetch_page(page_number)
+
+        return self.pages[page_number]
 
     async def format_page(self, menu, entries):
         offset = menu.current_page * self.per_page
 
-        search_phrase = self.search_phrase
+        search_phrase = self.query.text
         embed = Embed.from_dict({
             'title': f'Search results for \"{search_phrase[:255]}\"',
             'type': 'rich',
-            'fields': entries,
+            'fields': get_embed_fields(entries, offset)['fields_data'],
             'color': 0x89c6f6
         })
+        embed.set_footer(text=f'{self.total} results')
 
         return embed
 
 
+class Search_Menu(menus.MenuPages):
+    """ MenuPages that waits for the guild's turn with the Discord API before sending
+    or editing the results. The reactions menus adds and removes itself aren't counted.
+    """
+
+    async def send_initial_message(self, ctx, channel):
+        await discord_scheduler.wait(ctx.guild.id)
+        return await super().send_initial_message(ctx, channel)
+
+    async def show_page(self, page_number):
+        await discord_scheduler.wait(self.ctx.guild.id)
+        await super().show_page(page_number)
+
+
 # Load config keys
 with open('config.json', 'r') as f:
     config = json.load(f)
@@ -43,219 +122,583 @@ with open('config.json', 'r') as f:
 with open('discord_secrets.json', 'r') as f:
     discord_secrets = json.load(f)
 
+# DEBUG logs every image and search, OFF silences the bot's own logs entirely
+setup_logging(config['log-level'])
+log = logging.getLogger(__name__)
+
+# Prometheus endpoint, a port of 0 turns it off. Processes sharing a host each need
+# their own, METRICS_PORT overrides the configured one
+metrics_server = Metrics_Server(host=config['metrics-host'],
+                                port=int(os.environ.get('METRICS_PORT', config['metrics-port'])))
+
 # For debugging
 db_connect = config['db-connect']
-# TODO - Automatic index management
+# Read alias for searches, attachments go to rolling indices behind the index-name-write alias
 index_name = config['index-name']
 
-# Google vision client
-vision_client = vision.ImageAnnotatorClient()
+# Images over the OCR API limit are only worth downloading if they'll be shrunk
+if config['preprocess']:
+    max_download_size = config['max-download-size']
+else:
+    max_download_size = config['max-image-size']
+
+# Pooled HTTP session for fetching images
+downloader = Downloader(max_bytes=max_download_size,
+                        pool_size=config['download-pool-size'])
+
+# Google Vision or local Tesseract, picked by the ocr-backend config key
+ocr_backend = create_backend(config)
 
 # SQL db for storing blacklisted channels and admins
 sql_db = Sqlite3_db()
 
+# OCR text by image hash, shared across guilds
+ocr_cache = OCR_Cache(config['ocr-cache-path'],
+                      max_bytes=config['ocr-cache-max-bytes'])
 
-# Wait for elasticsearch to initialise before we try to run setup commands
-connected = False
-while not connected and db_connect:
-    try:
-        global db
-        db = Elastic_Database(index_name)
-        connected = True
-        print('[ELASTICSEARCH]: Successfully connected')
-    except Exception as e:
-        print(e)
-        print("[ELASTICSEARCH]: Elasticsearch not available yet, trying again in 10s...")
-        time.sleep(10)
+# Images already seen per guild, checked before asking elasticsearch
+dedup_cache = Dedup_Cache(capacity=config['dedup-cache-size'],
+                          max_distance=config['dedup-max-distance'],
+                          sql_db=sql_db if config['dedup-persist'] else None)
+
+
+# In queue mode images are handed to worker.py processes instead of the local pipeline
+if config['ingest-mode'] == 'queue':
+    job_queue = Job_Queue(config['job-queue-path'],
+                          claim_timeout=config['job-claim-timeout'],
+                          max_attempts=config['job-max-attempts'])
+else:
+    job_queue = None
+
+# Images OCR'ed per second within the Vision quota, and Discord API calls per second,
+# both shared fairly between guilds
+ocr_scheduler = Fair_Scheduler('ocr', config['ocr-rate-limit'], burst=config['ocr-rate-burst'])
+discord_scheduler = Fair_Scheduler('discord', config['discord-rate-limit'], burst=config['discord-rate-burst'])
+
+# Pages of search results, dropped for a guild whenever new attachments are indexed in it
+search_cache = Search_Cache(capacity=config['search-cache-size'],
+                            ttl=config['search-cache-ttl'])
+
+# Elasticsearch's index.max_result_window, the furthest from + size can reach
+MAX_RESULT_WINDOW = 10000
 
 
-async def handle_attachments(message: discord.message.Message) -> None:
-    """ Process attached image
+def invalidate_search_cache(guild_ids: set) -> None:
+    for guild_id in guild_ids:
+        search_cache.invalidate(guild_id)
+
+
+async def watch_worker_writes(interval=1.0) -> None:
+    """ Drop cached searches for guilds the ingestion workers have written to,
+    their write listeners only run in the worker processes
+    """
+    since = time.time()
+    while True:
+        await asyncio.sleep(interval)
+        now = time.time()
+        try:
+            # Workers commit their writes a little after timestamping them, look back a few seconds
+            invalidate_search_cache(await job_queue.written_since(since - 5))
+            since = now
+        except Exception as e:
+            log.warning('polling worker writes failed: %r', e)
+
+
+if db_connect:
+    db = Elastic_Database(index_name, pool_size=config['es-pool-size'],
+                          shards=config['es-shards'],
+                          rollover_max_size=config['es-rollover-max-size'],
+                          rollover_max_age=config['es-rollover-max-age'],
+                          warm_after=config['es-warm-after'],
+                          delete_after=config['es-delete-after'])
+    db.add_write_listener(invalidate_search_cache)
+
+
+async def setup(migrate=True) -> None:
+    """ Start the metrics endpoint, wait for elasticsearch to initialise and run the setup commands
+
+    Keyword Arguments:
+        migrate {bool} -- Migrate older indices from this process, only one process should (default: {True})
+    """
+    if metrics_server.port:
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            # Usually another process on the host has the port, the bot works without it
+            log.error('metrics endpoint not started on port=%d, set METRICS_PORT: %r', metrics_server.port, e)
+
+    while db_connect:
+        try:
+            await db.connect(migrate=migrate)
+            log.info('connected to elasticsearch')
+            return
+        except Exception as e:
+            log.warning('elasticsearch not available yet, trying again in 10s: %r', e)
+            await asyncio.sleep(10)
+
+
+# Attachments are written in bulk once enough are waiting or every few seconds
+if db_connect:
+    bulk_buffer = Bulk_Buffer(db,
+                              max_docs=config['bulk-max-docs'],
+                              flush_interval=config['bulk-flush-interval'],
+                              max_retries=config['bulk-max-retries'])
+
+
+async def handle_attachments(message: discord.message.Message, skip_urls=()) -> list:
+    """ Process every attached and embedded image in the message
 
     Arguments:
         message {discord.message.Message} -- discord.py
+
+    Keyword Arguments:
+        skip_urls {iterable} -- Images handled already, e.g. before the message was edited (default: {()})
+
+    Returns:
+        list -- Futures from index_jobs, empty in queue mode or if nothing is written
     """
-    # Get the Discord CDN url
-    url = message.attachments[0].url
+    # Don't save anything sent in a blacklisted channel
+    if sql_db.is_blacklisted(message.guild.id, message.channel.id):
+        log.debug('channel_id=%s blacklisted, skipping message', message.channel.id)
+        return []
 
-    attachment = message.attachments[0]
+    urls = [url for url in get_image_urls(message) if url not in skip_urls]
+    if not urls:
+        return []
 
-    # Get the raw bytes of the attachment
-    filebytes = await attachment.read()
+    # Sharded deployments leave the images to the ingestion workers
+    if job_queue is not None:
+        job_queue.put([Image_Job(url, message).to_dict() for url in urls])
+        log.debug('queued jobs=%d for the workers', len(urls))
+        return []
 
-    # Guess the filetype
-    kind = filetype.guess(filebytes)
+    # Fan the images out to the pipeline, the message takes as long as its slowest image
+    jobs = await asyncio.gather(*[save_image_text(url, message) for url in urls])
 
-    print(f'[URL]: {url}')
-    print(f'[FILETYPE]: {kind.mime}')
+    return await index_jobs(jobs)
 
-    # Return if it's not an image
-    if not 'image' in kind.mime:
-        return
 
-    # Return if the image is larger than 10MB, this is a limit of Google's OCR API
-    if attachment.size > 10000000:
-        print(f'[INFO]: Image too large, size: {attachment.size}')
-        return
+async def index_jobs(jobs: list) -> list:
+    """ Queue the attachments of finished jobs to be written in bulk. Each image
+        is only remembered by the dedup cache once Elasticsearch has acked it,
+        so one that fails to save isn't skipped when it's posted again
 
-    # Save the image if it wasn't sent in a blacklisted channel
-    if str(message.channel.id) not in sql_db.get_blacklisted_channels(message.guild.id):
-        await save_image_text(url, message)
-    else:
-        print(
-            f"[BLACKLIST]: channel_id {message.channel.id} in blacklisted channels")
+    Arguments:
+        jobs {list} -- Image_Jobs that came out of the pipeline, dropped ones are None
 
+    Returns:
+        list -- Futures from Bulk_Buffer.add, True once each attachment is saved
+    """
+    jobs = [job for job in jobs if job]
+    if not jobs:
+        return []
 
-def search(guild_id: str, phrase="", queried_user_id="") -> str:
-    """ Return matching results from elasticsearch, based on a search phrase,
-        a users id and the server the message was sent in
+    if not db_connect:
+        log.debug('db-connect is off, not saving docs=%d', len(jobs))
+        return []
+
+    futures = await bulk_buffer.add([build_attachment(job) for job in jobs])
+    log.debug('queued docs=%d for saving', len(jobs))
+
+    for job, future in zip(jobs, futures):
+        future.add_done_callback(functools.partial(remember_saved_job, job))
+
+    return futures
+
+
+def remember_saved_job(job: Image_Job, future: asyncio.Future) -> None:
+    if future.result():
+        dedup_cache.add(job.guild_id, job.hash, job.dhash)
+
+
+def get_image_urls(message: discord.message.Message) -> list:
+    """ Get the URLs of all attachments and image embeds in a message
+
+    Arguments:
+        message {discord.message.Message} -- discord.py
+
+    Returns:
+        list -- CDN URLs, without duplicates
+    """
+    urls = []
+
+    for attachment in message.attachments:
+        # Discord only sets the dimensions for images, skip everything else without downloading it
+        if attachment.height is None:
+            continue
+
+        # Skip images too large to download, anything over the OCR API limit gets shrunk later
+        if attachment.size > max_download_size:
+            log.info('url=%s too large size=%d', attachment.url, attachment.size)
+            continue
+
+        urls.append(attachment.url)
+
+    # The embed's own URL can point anywhere, including hosts on our network, so
+    # only ever fetch Discord's media proxy copy of it
+    for embed in message.embeds:
+        if embed.type == 'image' and embed.thumbnail.proxy_url:
+            urls.append(embed.thumbnail.proxy_url)
+        elif embed.image.proxy_url:
+            urls.append(embed.image.proxy_url)
+
+    return list(dict.fromkeys(urls))
+
+
+async def search(guild_id: str, query: Search_Query, size=5, search_after=None, offset=0,
+                 track_total=True) -> tuple:
+    """ Return one page of matching results from elasticsearch, based on a search phrase,
+        filters and the server the message was sent in
 
     Arguments:
         guild_id {str} -- ID of the server to query images for
+        query {Search_Query} -- Phrase, filters and sort order
 
     Keyword Arguments:
-        phrase {str} -- The OCR'ed text to search for (default: {""})
-        queried_user_id {str} -- ID of the user who sent the image (default: {""})
+        size {int} -- Number of results in the page (default: {5})
+        search_after {list} -- Sort values of the last result of the previous page (default: {None})
+        offset {int} -- Results to skip when there's no search_after, up to MAX_RESULT_WINDOW (default: {0})
+        track_total {bool} -- Count every match, only needed for the first page (default: {True})
 
     Returns:
-        str -- [description]
+        tuple -- (results, total number of matches or None if not counted, search_after for the next page)
     """
     # If debug mode
     if not db_connect:
-        return ""
+        return [], 0, None
+
+    if query.is_empty():
+        # Empty search command
+        log.debug('empty search')
+        return [], 0, None
+
+    # Repeated and popular searches are served from memory
+    cache_key = search_cache.key(guild_id, query.key(), size, search_after, offset, track_total)
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached
 
     search = Search()
 
-    if not phrase and not queried_user_id:
-        # Empty search command
-        print(f'[SEARCH]: Empty search - returning')
-        return
-    elif not phrase and queried_user_id:
-        # Empty phrase and non empty user id
-        print(f'[SEARCH]: Searching for user: {queried_user_id}')
-        q = Q('bool', must=[Q('match', author_id=int(queried_user_id)),
-                            Q('match', guild_id=guild_id)])
-    elif phrase and queried_user_id:
-        # Non empty phrase and user id
-        print(
-            f'[SEARCH]: Searching for phrase: {phrase} from user: {queried_user_id}')
-        q = Q('bool', must=[Q('match', text=phrase),
-                            Q('match', author_id=int(queried_user_id)),
-                            Q('match', guild_id=guild_id)])
+    # User, channel, date and type narrow the results without being scored
+    filters = query.filters(guild_id)
+    phrase = query.phrase
+
+    log.debug('search guild_id=%s phrase=%r fuzzy=%s filters=%s sort=%s',
+              guild_id, phrase, query.fuzzy, filters, query.sort)
+
+    if not phrase:
+        # Filters only
+        q = Q('bool', filter=filters)
+    elif query.fuzzy:
+        # Typo tolerant, ranked by relevance with exact phrase matches first
+        q = Q('bool', must=[fuzzy_text_query(phrase)],
+              should=[Q('match_phrase', text={'query': phrase, 'boost': 3})],
+              filter=filters)
     else:
-        # Non empty phrase and empty user id
-        print(f'[SEARCH]: Searching for phrase: {phrase}')
-        q = Q('bool', must=[Q('match_phrase', text=phrase),
-                            Q('match', guild_id=guild_id)])
+        # The exact phrase, whether or not a user is given
+        q = Q('bool', must=[Q('match_phrase', text=phrase)], filter=filters)
+
+    # Only fetch the fields used in the embed, and only one page of them
+    s = search.query(q) \
+        .sort(*query.sort_fields(db.tiebreaker)) \
+        .source(['filename', 'author_username', 'url', 'message_url']) \
+        .extra(size=size, track_total_hits=track_total)
+
+    # One short snippet around the match, the trigram field covers fuzzy only matches
+    if phrase:
+        s = s.highlight_options(type='unified', fragment_size=100, number_of_fragments=1,
+                                pre_tags=[HIGHLIGHT_START], post_tags=[HIGHLIGHT_END]) \
+            .highlight('text', 'text.trigram')
+
+    if search_after:
+        s = s.extra(search_after=search_after)
+    elif offset:
+        s = s.extra(from_=offset)
 
     # Execute the query
-    s = search.query(q)
+    res = await db.search(s)
 
     # Fields that can be used in the embed
     result = [{
         'filename': h.filename,
         'author': h.author_username,
         'url': h.url,
-        'message_url': h.message_url,
+        'message_url': getattr(h, 'message_url', ''),
+        'highlight': get_highlight(h),
         'id': h.meta.id
-    } for h in s.scan()]
+    } for h in res.hits]
+
+    search_after = list(res.hits[-1].meta.sort) if result else None
+    total = res.hits.total.value if track_total else None
+
+    search_cache.put(cache_key, (result, total, search_after))
 
-    return result
+    return result, total, search_after
 
 
-async def save_image_text(url: str, message: discord.message.Message) -> None:
-    """ Download the image, check if it already exists in the index, run OCR on the image,
-        save the info to elasticsearch
+def fuzzy_text_query(phrase: str) -> Q:
+    """ Match OCR text that is close to the phrase: whole words within an edit or two,
+        or most of the phrase's trigrams for misreads like split or merged words
 
     Arguments:
-        url {str} -- CDN URL for the image
-        message {discord.message.Message} -- discord.py
+        phrase {str} -- Text to search for
+
+    Returns:
+        Q -- Query for the must clause of a search
     """
-    with get_image_from_url(url) as image_file:
-        hash = md5(image_file.read()).hexdigest()
-        print(f'[HASH]: {hash}')
+    return Q('bool', should=[
+        # The first character has to match, which keeps the term expansion cheap on big indices
+        Q('match', text={'query': phrase, 'fuzziness': 'AUTO', 'prefix_length': 1,
+                         'max_expansions': 20, 'operator': 'and'}),
+        Q('match', **{'text.trigram': {'query': phrase, 'minimum_should_match': '75%'}})
+    ], minimum_should_match=1)
 
-        if db_connect:
-            if db.exists(str(message.guild.id), hash=hash):
-                print(f"[INFO]: Image {url} already exists in index")
-                return
 
-        image_file.seek(0)
-        filename = get_filename_from_url(url)
-        ocr_text = detect_text(image_file)
+# Placeholders for the highlight tags, swapped for bold once the OCR text is escaped
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+
+def get_highlight(hit) -> str:
+    """ The highlighted snippet of a search hit as Discord markdown
+
+    Arguments:
+        hit -- elasticsearch_dsl Hit
+
+    Returns:
+        str -- Snippet with the matches in bold, empty if there wasn't one
+    """
+    highlight = getattr(hit.meta, 'highlight', None)
+    if highlight is None:
+        return ''
+
+    highlight = highlight.to_dict()
+    for field in ('text', 'text.trigram'):
+        fragments = highlight.get(field)
+        if fragments:
+            snippet = escape_markdown(' '.join(fragments[0].split()))
+            return snippet.replace(HIGHLIGHT_START, '**').replace(HIGHLIGHT_END, '**')
+
+    return ''
+
+
+async def run_blocking(func, *args, **kwargs):
+    """ Run a blocking function in the default executor so it doesn't stall the event loop
+
+    Arguments:
+        func {callable} -- Blocking function to call
+
+    Returns:
+        Whatever func returns
+    """
+    loop = asyncio.get_event_loop()
+
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+async def download_stage(job: Image_Job) -> Image_Job:
+    log.debug('download url=%s', job.url)
+
+    # One streamed download, the bytes are reused for hashing and OCR
+    job.image, extension = await downloader.download(job.url)
+
+    if job.image is None:
+        return None
+
+    # The type the content was sniffed as, for the type: search filter. The URL can lie.
+    job.file_type = FILE_TYPES.get(extension)
+
+    return job
+
+
+def hash_image(content: bytes) -> tuple:
+    """ MD5 and, if dedup-perceptual is on, perceptual hash of an image
+
+    Arguments:
+        content {bytes} -- Raw image bytes
+
+    Returns:
+        tuple -- (md5 hex digest, dhash or None)
+    """
+    if not config['dedup-perceptual']:
+        return md5(content).hexdigest(), None
+
+    return md5(content).hexdigest(), image_dhash(content, size=config['dedup-hash-size'])
 
-        if not ocr_text:
-            print(f'[INFO]: No text detected in {filename}')
-            return
 
-        print(f'[OCR TEXT]: {ocr_text.encode()}')
+async def hash_stage(job: Image_Job) -> Image_Job:
+    job.hash, job.dhash = await run_blocking(hash_image, job.image)
+    log.debug('url=%s hash=%s', job.url, job.hash)
 
-    doc = Attachment(timestamp=int(time.time()*1000), author_id=int(message.author.id),
-                     author_username=message.author.name+"#"+message.author.discriminator,
-                     channel=message.channel.name, category_id=message.channel.category_id,
-                     guild=message.guild.name, guild_id=message.guild.id,
-                     message_url=message.jump_url, url=url, text=ocr_text, hash=hash,
-                     filename=filename)
+    if dedup_cache.check(job.guild_id, job.hash, job.dhash):
+        log.debug('url=%s already seen', job.url)
+        return None
 
     if db_connect:
-        db.save_attachment(doc, index_name)
-        print("[INFO]: Attachment saved")
-    else:
-        print("No db_connect")
+        if await db.exists(str(job.guild_id), hash=job.hash):
+            log.debug('url=%s already indexed', job.url)
+            dedup_cache.add(job.guild_id, job.hash, job.dhash)
+            return None
 
-    return
+    # Reuse the text if this image was already OCR'ed, in any guild
+    job.text = await ocr_cache.get(job.hash)
 
+    return job
 
-def get_filename_from_url(url: str) -> str:
-    """ Get the files name from the CDN URL
+
+async def preprocess_stage(job: Image_Job) -> Image_Job:
+    # Already OCR'ed somewhere, no need to shrink it
+    if job.text is not None:
+        return job
+
+    # Most images are within both limits already, don't send them to the process pool
+    if not needs_shrinking(job.image, config['ocr-max-side'], config['max-image-size']):
+        return job
+
+    loop = asyncio.get_event_loop()
+    try:
+        shrunk = await loop.run_in_executor(get_process_pool(config['ocr-pool-size']), shrink_image,
+                                            job.image, config['ocr-max-side'], config['max-image-size'])
+    except Exception as e:
+        # Couldn't decode it, send the original if the OCR backend will take it
+        log.warning('preprocess failed url=%s: %r', job.url, e)
+        shrunk = job.image if len(job.image) <= config['max-image-size'] else None
+
+    if shrunk is None:
+        log.info('url=%s too large even after shrinking', job.url)
+        return None
+
+    preprocess_stats['bytes_in'] += len(job.image)
+    preprocess_stats['bytes_out'] += len(shrunk)
+    job.image = shrunk
+
+    return job
+
+
+async def ocr_stage(job: Image_Job) -> Image_Job:
+    if job.text is None:
+        job.text = await detect_text(job.image)
+        await ocr_cache.put(job.hash, job.text)
+
+    # Free the image bytes, nothing after this stage needs them
+    job.image = None
+
+    if not job.text:
+        # Nothing will be written for it, so reposts can be skipped straight away
+        dedup_cache.add(job.guild_id, job.hash, job.dhash)
+        log.debug('url=%s no text detected', job.url)
+        return None
+
+    log.debug('url=%s text=%r', job.url, job.text)
+
+    return job
+
+
+def build_attachment(job: Image_Job) -> Attachment:
+    """ Create the Attachment document for a job that made it through the pipeline
 
     Arguments:
-        url {str} -- CDN URL of the image
+        job {Image_Job} -- Finished job
 
     Returns:
-        str -- File name
+        Attachment -- Document ready to be indexed
     """
-    filename = url[url.rfind("/")+1:]
+    return Attachment(timestamp=job.timestamp, author_id=int(job.author_id),
+                      author_username=job.author_username,
+                      channel=job.channel, channel_id=job.channel_id, category_id=job.category_id,
+                      guild=job.guild, guild_id=job.guild_id,
+                      message_url=job.message_url, url=job.url, text=job.text, hash=job.hash,
+                      filename=get_filename_from_url(job.url), file_type=job.file_type)
+
+
+# Bytes sent to and received from the preprocessing stage
+preprocess_stats = {'bytes_in': 0, 'bytes_out': 0}
+
+# Download -> hash/dedup -> preprocess -> OCR, each stage with its own worker count.
+# Indexing is done per message in one bulk request by handle_attachments.
+pipeline = Ingestion_Pipeline(queue_size=config['pipeline-queue-size'])
+pipeline.add_stage('download', download_stage,
+                   workers=config['pipeline-workers']['download'])
+pipeline.add_stage('hash', hash_stage,
+                   workers=config['pipeline-workers']['hash'])
+if config['preprocess']:
+    pipeline.add_stage('preprocess', preprocess_stage,
+                       workers=config['pipeline-workers']['preprocess'])
+pipeline.add_stage('ocr', ocr_stage,
+                   workers=config['pipeline-workers']['ocr'])
+
+# Shared limit on images in flight across all messages
+image_semaphore = asyncio.Semaphore(config['max-concurrent-images'])
+
+
+async def save_image_text(url: str, message: discord.message.Message) -> Image_Job:
+    """ Queue the image to be downloaded, checked against the index and OCR'ed,
+        then wait for it to come out the other end
 
-    return filename
+    Arguments:
+        url {str} -- CDN URL for the image
+        message {discord.message.Message} -- discord.py
+
+    Returns:
+        Image_Job -- The finished job, None if it was a duplicate, had no text or failed
+    """
+    return await run_job(Image_Job(url, message))
 
 
-def get_image_from_url(url: str) -> io.BytesIO:
-    """ Return a BytesIO object of the image
+async def run_job(job: Image_Job) -> Image_Job:
+    """ Put a job through the pipeline and wait for it to come out the other end
+
+    Arguments:
+        job {Image_Job} -- New job
 
     Returns:
-        io.BytesIO -- In memory file-like object
+        Image_Job -- The finished job, None if it was a duplicate, had no text or failed
     """
-    r = requests.get(url, stream=True)
-    image_file = io.BytesIO(r.content)
+    # Wait for the guild's turn before taking a slot, so a busy guild can't fill the pipeline.
+    # Duplicates and cached images take a token too, which errs on the side of the quota.
+    await ocr_scheduler.wait(job.guild_id)
 
-    return image_file
+    async with image_semaphore:
+        future = await pipeline.submit(job)
 
+        return await future
 
-def detect_text(image_file):
-    # Read the bytes of the BytesIO object
-    image = vision.types.Image(content=image_file.read())
 
-    text_detection_response = vision_client.text_detection(image=image)
+def get_filename_from_url(url: str) -> str:
+    """ Get the files name from the CDN URL
 
-    annotations = text_detection_response.text_annotations
+    Arguments:
+        url {str} -- CDN URL of the image
 
-    if len(annotations) > 0:
-        text = annotations[0].description
-    else:
-        text = ''
+    Returns:
+        str -- File name
+    """
+    filename = url[url.rfind("/")+1:]
 
-    return text.replace('\n', ' ')
+    return filename
+
+
+async def detect_text(content: bytes) -> str:
+    """ OCR the image with the configured backend
+
+    Arguments:
+        content {bytes} -- Raw image bytes
+
+    Returns:
+        str -- Detected text, empty if none was found
+    """
+    return await ocr_backend.detect_text(content)
 
 
 async def send_message(message, channel):
     await channel.send(message)
 
 
-def get_embed_fields(search_result):
+def get_embed_fields(search_result, offset=0):
     fields = {}
     fields['fields_data'] = []
-    for i, doc in enumerate(search_result):
+    for i, doc in enumerate(search_result, start=offset):
         filename = doc['filename']
         author = doc['author']
         url = doc['url']
@@ -264,38 +707,35 @@ def get_embed_fields(search_result):
             message_url = doc['message_url']
         except KeyError:
             message_url = ''
+        value = f'[{filename}]({url}) - [jump]({message_url})'
+        if doc.get('highlight'):
+            value += f"\n{doc['highlight']}"
         fields['fields_data'].append({
             'name': f'{i+1}. {author}',
-            'value': f'[{filename}]({url}) - [jump]({message_url})'
+            'value': value
         })
 
     return fields
 
 
-async def search_command(ctx, args):
-    # Remove the user mention string from the search phrase if it is present
+async def search_command(ctx):
+    # Parse the raw text, discord.py strips the quotes that ask for an exact match from args
+    text = ctx.message.content[len(ctx.prefix) + len(ctx.invoked_with):]
+    channels = {channel.name.lower(): channel.id for channel in ctx.guild.text_channels}
+
     try:
-        if ctx.message.mentions:
-            queried_user_id = ctx.message.mentions[0].id
-            search_phrase = ' '.join(args).replace(
-                '<@!'+str(queried_user_id)+'>', '').strip()
-        else:
-            # Regex for 18 digit user id
-            r = re.compile('[0-9]{18}')
-            queried_user_id = list(filter(r.fullmatch, args))[0]
-            search_phrase = ' '.join(args).replace(queried_user_id, '').strip()
-    except IndexError:
-        queried_user_id = None
-        search_phrase = ' '.join(args).strip()
-
-    search_result = search(ctx.guild.id, phrase=search_phrase,
-                           queried_user_id=queried_user_id)
-
-    fields = get_embed_fields(search_result)
-
-    fields['search_phrase'] = search_phrase
-    pages = menus.MenuPages(source=MySource(
-        fields), clear_reactions_after=True, timeout=30)
+        query = parse_search(text, channels, fuzzy=config['search-fuzzy'])
+    except ValueError as e:
+        await ctx.send(str(e))
+        return
+
+    if query.is_empty():
+        await ctx.send('Give me something to search for :)')
+        return
+
+    # Results are fetched page by page as the user navigates
+    pages = Search_Menu(source=MySource(ctx.guild.id, query),
+                        clear_reactions_after=True, timeout=30)
     await pages.start(ctx)
 
     return
@@ -307,9 +747,8 @@ async def ignore_command(ctx, args):
     guild_id = str(ctx.guild.id)
     author_id = str(ctx.author.id)
 
-    # TODO - global guild admins and only refresh after an update to them, might need to make a new client for every guild
     guild_admins = sql_db.get_admins(ctx.guild.id)
-    guild_admins.append(discord_secrets['owner-id'])
+    guild_admins.add(discord_secrets['owner-id'])
 
     if author_id in guild_admins:
         # TODO - If able to blacklist by channel if, check if channel is actually in guild before adding to db
@@ -317,18 +756,16 @@ async def ignore_command(ctx, args):
 
         await ctx.send(f"Channel {channel.mention} ignored :)")
 
-        print(
-            f"[BLACKLIST]: Channel {channel.name} - {channel.id} blacklisted")
+        log.info('channel=%s channel_id=%s blacklisted', channel.name, channel.id)
     # Not admin
     else:
         await ctx.send(f'You must be an admin to do that :D')
-        print(
-            f"[BLACKLIST]: Non admin - {author_id} tried to blacklist channel {channel.name} - {channel.id}")
+        log.info('non admin user_id=%s tried to blacklist channel_id=%s', author_id, channel.id)
 
 
 async def link_command(ctx, args):
     es_id = args[0]
-    jump_url = db.get_jump_url_by_id(es_id)
+    jump_url = await db.get_jump_url_by_id(es_id)
 
     # TODO - Maybe deny before we get jump_url
     if jump_url:
@@ -341,9 +778,8 @@ async def link_command(ctx, args):
 
 async def admin_command(ctx, args):
     guild_admins = sql_db.get_admins(ctx.guild.id)
-    guild_admins.append(discord_secrets['owner-id'])
-    print(
-        f"[ADMINS]: Guild admins for guild {ctx.guild.name} are {guild_admins}")
+    guild_admins.add(discord_secrets['owner-id'])
+    log.debug('guild_id=%s admins=%s', ctx.guild.id, guild_admins)
 
     author_id = str(ctx.author.id)
     if author_id in guild_admins:
@@ -358,5 +794,207 @@ async def admin_command(ctx, args):
             await ctx.send(f"{user.name} is no longer a bot admin :(")
     else:
         await ctx.send(f"You must be an admin to do that :D")
-        print(
-            f"[ADMIN]: Non admin - {ctx.author.id} tried to use admin command on {user.name}")
+        log.info('non admin user_id=%s tried to use the admin command', ctx.author.id)
+
+
+# Guilds with a backfill in progress
+backfills_running = set()
+
+
+async def backfill_command(ctx, args):
+    """ Index the images in every non blacklisted channel's history, picking up
+    from the last checkpoint of each channel
+    """
+    guild_admins = sql_db.get_admins(ctx.guild.id)
+    guild_admins.add(discord_secrets['owner-id'])
+
+    if str(ctx.author.id) not in guild_admins:
+        await ctx.send(f"You must be an admin to do that :D")
+        log.info('non admin user_id=%s tried to backfill', ctx.author.id)
+        return
+
+    if ctx.guild.id in backfills_running:
+        await ctx.send("A backfill is already running in this server")
+        return
+
+    backfills_running.add(ctx.guild.id)
+    try:
+        await backfill_guild(ctx)
+    finally:
+        backfills_running.discard(ctx.guild.id)
+
+
+async def backfill_guild(ctx):
+    batch_size = config['backfill-batch-size']
+    images_per_second = config['backfill-images-per-second']
+
+    progress = await ctx.send("Starting backfill...")
+    start = time.monotonic()
+    last_update = start
+    scanned = 0
+    images = 0
+
+    for channel in ctx.guild.text_channels:
+        if sql_db.is_blacklisted(ctx.guild.id, channel.id):
+            continue
+
+        checkpoint = sql_db.get_backfill_checkpoint(channel.id)
+        after = Object(id=int(checkpoint)) if checkpoint else None
+
+        batch = []
+        last_message = None
+        try:
+            async for message in channel.history(limit=None, after=after, oldest_first=True):
+                scanned += 1
+                last_message = message
+                if message.author == ctx.me or not (message.attachments or message.embeds):
+                    continue
+
+                batch.append(message)
+                if len(batch) < batch_size:
+                    continue
+
+                images += await backfill_batch(ctx.guild.id, channel.id, batch)
+                batch = []
+
+                # Stay under the configured rate, bulk writes and dedup happen in handle_attachments
+                elapsed = time.monotonic() - start
+                if images / images_per_second > elapsed:
+                    await asyncio.sleep(images / images_per_second - elapsed)
+
+                if time.monotonic() - last_update > 10:
+                    last_update = time.monotonic()
+                    await edit_message(progress, content=backfill_progress(channel, scanned, images, start))
+
+            images += await backfill_batch(ctx.guild.id, channel.id, batch)
+
+            # Everything up to the newest message is saved, including text only ones after the last image
+            if last_message is not None:
+                sql_db.set_backfill_checkpoint(ctx.guild.id, channel.id, last_message.id)
+        except Forbidden:
+            log.info('backfill has no access to channel=%s channel_id=%s', channel.name, channel.id)
+            continue
+        except RuntimeError as e:
+            log.error('backfill stopped: %s', e)
+            await edit_message(progress, content=f"Backfill stopped, some images couldn't be saved. "
+                                                 f"Run it again to pick up from #{channel.name} :( "
+                                                 f"{backfill_progress(None, scanned, images, start)}")
+            return
+
+        await edit_message(progress, content=backfill_progress(channel, scanned, images, start))
+
+    await edit_message(progress, content=f"Backfill done :) {backfill_progress(None, scanned, images, start)}")
+
+
+async def backfill_batch(guild_id: str, channel_id: str, batch: list) -> int:
+    """ Index a batch of messages then move the channel's checkpoint past them,
+        once every attachment has been written to elasticsearch
+
+    Arguments:
+        guild_id {str} -- Discord guild ID
+        channel_id {str} -- Discord channel ID
+        batch {list} -- Messages with attachments or embeds, oldest first
+
+    Raises:
+        RuntimeError: If some attachments couldn't be saved, the checkpoint isn't moved
+
+    Returns:
+        int -- Number of images found in the batch
+    """
+    if not batch:
+        return 0
+
+    results = await asyncio.gather(*[handle_attachments(message) for message in batch])
+    futures = [future for message_futures in results for future in message_futures]
+
+    # Don't wait for the periodic flush, a crash before it would lose the batch for good
+    if futures:
+        await bulk_buffer.flush()
+        saved = await asyncio.gather(*futures)
+        if not all(saved):
+            raise RuntimeError(f'{saved.count(False)} attachments in channel_id={channel_id} failed to save')
+
+    sql_db.set_backfill_checkpoint(guild_id, channel_id, batch[-1].id)
+
+    return sum(len(get_image_urls(message)) for message in batch)
+
+
+async def edit_message(message: discord.message.Message, **kwargs) -> None:
+    """ Edit a message the bot sent once it's the guild's turn with the Discord API
+
+    Arguments:
+        message {discord.message.Message} -- Message to edit, keyword arguments go to Message.edit
+    """
+    await discord_scheduler.wait(message.guild.id if message.guild else 0)
+    await message.edit(**kwargs)
+
+
+def backfill_progress(channel, scanned: int, images: int, start: float) -> str:
+    elapsed = time.monotonic() - start
+    where = f"#{channel.name}: " if channel else ""
+
+    return (f"{where}{scanned} messages scanned, {images} images, "
+            f"{images / elapsed if elapsed else 0:.2f} images/s")
+
+
+async def stats_command(ctx, args):
+    lines = []
+    for stage in pipeline.stats():
+        lines.append(f"**{stage['name']}** ({stage['workers']} workers) - "
+                     f"queued: {stage['queued']}, processed: {stage['processed']}, "
+                     f"dropped: {stage['dropped']}, errors: {stage['errors']}, "
+                     f"{stage['per_second']:.2f}/s, avg {stage['avg_seconds']:.3f}s")
+
+    ocr_stats = ', '.join(f'{k}: {v:.3f}' if isinstance(v, float) else f'{k}: {v}'
+                          for k, v in ocr_backend.stats().items())
+    lines.append(f"**ocr ({ocr_backend.name})** - {ocr_stats}")
+
+    ocr_cache_stats = ', '.join(f'{k}: {v}' for k, v in ocr_cache.stats().items())
+    lines.append(f"**ocr cache** - {ocr_cache_stats}")
+
+    download_stats = ', '.join(f'{k}: {v}' for k, v in downloader.stats().items())
+    lines.append(f"**download** - {download_stats}")
+
+    if config['preprocess']:
+        lines.append(f"**preprocess** - bytes in: {preprocess_stats['bytes_in']}, "
+                     f"bytes out: {preprocess_stats['bytes_out']}")
+
+    dedup_stats = ', '.join(f'{k}: {v}' for k, v in dedup_cache.stats().items())
+    lines.append(f"**dedup** - {dedup_stats}")
+
+    search_cache_stats = ', '.join(f'{k}: {v}' for k, v in search_cache.stats().items())
+    lines.append(f"**search cache** - {search_cache_stats}")
+
+    if db_connect:
+        index_stats = ', '.join(f'{k}: {v}' for k, v in bulk_buffer.stats().items())
+        lines.append(f"**index** - {index_stats}")
+
+    if job_queue is not None:
+        job_queue_stats = ', '.join(f'{k}: {v}' for k, v in job_queue.stats().items())
+        lines.append(f"**job queue** - {job_queue_stats}")
+
+    for scheduler in (ocr_scheduler, discord_scheduler):
+        scheduler_stats = ', '.join(f'{k}: {v:.3f}' if isinstance(v, float) else f'{k}: {v}'
+                                    for k, v in scheduler.stats().items())
+        lines.append(f"**{scheduler.name} rate limit** - {scheduler_stats}")
+
+    await ctx.send('\n'.join(lines))
+
+
+async def shutdown() -> None:
+    """ Let queued images finish, write out any buffered attachments and stop the OCR backend """
+    if pipeline.tasks:
+        await pipeline.stop()
+
+    if db_connect:
+        await bulk_buffer.close()
+        await db.close()
+
+    await downloader.close()
+    ocr_backend.close()
+    close_process_pool()
+    await ocr_cache.close()
+    await sql_db.close()
+    if job_queue is not None:
+        await job_queue.close()
+    await metrics_server.stop()
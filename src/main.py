@@ -1,12 +1,14 @@
 import logging
 import json
-import random
-import string
-import aiohttp
+import os
+import time
 
-from discord import Game, Status, Webhook, AsyncWebhookAdapter
+from discord import Game, Status
 from discord.ext import commands
 from lib import *
+from metrics import Counter, Histogram
+from triggers import load_triggers
+from webhooks import Webhook_Pool
 
 # Load config keys
 with open('config.json', 'r') as f:
@@ -15,59 +17,111 @@ with open('config.json', 'r') as f:
 with open('discord_secrets.json', 'r') as f:
     discord_secrets = json.load(f)
 
-bot = commands.Bot(command_prefix=config['prefix-key'])
+COMMAND_SECONDS = Histogram('command_seconds', 'Time to handle a bot command', ['command'])
+COMMAND_ERRORS = Counter('command_errors_total', 'Bot commands that raised', ['command'])
 
 
-@bot.event
-async def on_ready():
-    print(f'We have logged in as {bot.user}')
-    game = Game('God')
-    await bot.change_presence(status=Status.online, activity=game)
+class OCR_Context(commands.Context):
+    """ Context whose replies wait for the guild's turn with the Discord API """
+
+    async def send(self, *args, **kwargs):
+        await discord_scheduler.wait(self.guild.id if self.guild else 0)
+        return await super().send(*args, **kwargs)
+
+
+class OCR_Bot_Mixin():
+    async def get_context(self, message, *, cls=OCR_Context):
+        return await super().get_context(message, cls=cls)
+
+    async def start(self, *args, **kwargs):
+        # Connect to elasticsearch on the bot's own event loop. With the shards split
+        # across processes only the one running shard 0 migrates older indices
+        shard_ids = getattr(self, 'shard_ids', None)
+        await setup(migrate=not shard_ids or 0 in shard_ids)
+
+        # Searches cached here go stale when a worker process indexes new images
+        if job_queue is not None:
+            asyncio.ensure_future(watch_worker_writes())
+
+        await super().start(*args, **kwargs)
+
+    async def close(self):
+        # Flush queued work before the connection and event loop go away
+        await shutdown()
+        await webhook_pool.close()
+        await super().close()
+
+    async def invoke(self, ctx):
+        start = time.perf_counter()
+        try:
+            await super().invoke(ctx)
+        finally:
+            if ctx.command is not None:
+                COMMAND_SECONDS.observe(time.perf_counter() - start, command=ctx.command.name)
+
+    async def on_command_error(self, ctx, error):
+        if ctx.command is not None:
+            COMMAND_ERRORS.inc(command=ctx.command.name)
+        await super().on_command_error(ctx, error)
+
+
+class OCR_Bot(OCR_Bot_Mixin, commands.Bot):
+    pass
+
+
+class Sharded_OCR_Bot(OCR_Bot_Mixin, commands.AutoShardedBot):
+    """ Runs some or all of the gateway shards in this process. Every guild is on
+    exactly one shard, so the per-guild state kept in memory stays consistent.
+    """
+    pass
+
 
+def create_bot() -> commands.Bot:
+    """ Single process bot, or a sharded one when "sharded" is set in the config.
+    "shard-count" null lets Discord pick the number of shards, "shard-ids" (or the
+    SHARD_IDS environment variable, e.g. 0,1) limits this process to some of them.
+    """
+    if not config['sharded']:
+        return OCR_Bot(command_prefix=config['prefix-key'])
 
-def randomword(length):
-    letters = string.ascii_lowercase
-    return ''.join(random.choice(letters) for i in range(length))
+    shard_ids = config['shard-ids']
+    if os.environ.get('SHARD_IDS'):
+        shard_ids = [int(shard_id) for shard_id in os.environ['SHARD_IDS'].split(',')]
 
+    if shard_ids and not config['shard-count']:
+        raise ValueError('shard-count has to be set to run a subset of the shards')
 
-async def send_webhook(channel, avatar_url: str, message: str):
-    webhook = await channel.create_webhook(name="week", reason="week bot")
+    return Sharded_OCR_Bot(command_prefix=config['prefix-key'],
+                           shard_count=config['shard-count'], shard_ids=shard_ids)
 
-    await webhook.send(content=message, avatar_url=avatar_url)
-    await webhook.delete()
 
+bot = create_bot()
 
-def is_anagram(ele1, ele2):
-    l1 = [c for c in ele1 if c not in string.whitespace and c not in string.punctuation]
-    l2 = [c for c in ele2 if c not in string.whitespace and c not in string.punctuation]
-    l1.sort()
-    l2.sort()
-    return l1 == l2
+# Webhook replies to messages that are anagrams of a trigger phrase
+trigger_matcher = load_triggers(config['triggers-path'])
+webhook_pool = Webhook_Pool(name="week", reason="week bot", scheduler=discord_scheduler)
 
 
 @bot.event
-async def on_message(message):
-    week_avatar_url = f"https://macs-week-image.herokuapp.com/image/{randomword(7)}.png"
-    triggers = [
-        ("what week is it", send_webhook, week_avatar_url, "_ _"),
-        ("what week is it not", send_webhook,
-         week_avatar_url, f"https://i.imgur.com/BGBvnvq.jpg"),
-        ("stupid week bot", send_webhook,
-         week_avatar_url, f"https://i.imgur.com/WXS93ht.jpg")
-    ]
+async def on_ready():
+    logging.getLogger('main').info('logged in as %s', bot.user)
+    game = Game('God')
+    await bot.change_presence(status=Status.online, activity=game)
+
 
+@bot.event
+async def on_message(message):
    # Return if bot's own message
     if message.author == bot.user:
         return
 
     # Check for trigger
-    for trigger, callback, avatar_url, webhook_message in triggers:
-        if is_anagram(message.content.lower(), trigger):
-            await callback(message.channel, avatar_url=avatar_url, message=webhook_message)
-            break
+    trigger = trigger_matcher.match(message.content)
+    if trigger is not None:
+        await webhook_pool.send(message.channel, content=trigger.message, avatar_url=trigger.get_avatar_url())
 
-    # If the message has attachments
-    if message.attachments:
+    # If the message has attached or embedded images
+    if get_image_urls(message):
         await handle_attachments(message)
         return
 
@@ -76,9 +130,20 @@ async def on_message(message):
     return
 
 
+@bot.event
+async def on_message_edit(before, after):
+    if after.author == bot.user:
+        return
+
+    # Link previews arrive as an edit shortly after the message, only the new images need saving
+    old_urls = set(get_image_urls(before))
+    if any(url not in old_urls for url in get_image_urls(after)):
+        await handle_attachments(after, skip_urls=old_urls)
+
+
 @bot.command(name='search')
 async def handle_search_command(ctx, *args):
-    await search_command(ctx, args)
+    await search_command(ctx)
     return
 
 
@@ -100,7 +165,19 @@ async def handle_link_command(ctx, *args):
     return
 
 
-logging.basicConfig(level=logging.INFO)
+@bot.command(name='backfill')
+async def handle_backfill_command(ctx, *args):
+    await backfill_command(ctx, args)
+    return
+
+
+@bot.command(name='stats')
+async def handle_stats_command(ctx, *args):
+    await stats_command(ctx, args)
+    return
+
+
+# The bot's own logging is set up by lib from the log-level config key
 logger = logging.getLogger('discord')
 logger.setLevel(logging.ERROR)
 handler = logging.FileHandler(
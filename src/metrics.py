@@ -0,0 +1,203 @@
+import logging
+import threading
+
+from aiohttp import web
+
+
+log = logging.getLogger(__name__)
+
+
+class Metric():
+    """ A named family of values, one per combination of label values.
+    Metrics add themselves to REGISTRY when they're created.
+    """
+    kind = ''
+
+    def __init__(self, name: str, description: str, labels=(), registry=None):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f'{self.name} takes labels {self.labels}, got {tuple(labels)}')
+
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, key: tuple, extra=()) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                   for _, value in pairs)
+
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def samples(self) -> list:
+        """ Lines of the Prometheus text format for every label combination """
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self) -> list:
+        return [f'{self.name}{self._format_labels(key)} {value}' for key, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    """ A value that goes up and down, either set directly or read from a
+    function whenever the metrics are scraped
+    """
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        self.values[self._key(labels)] = value
+
+    def set_function(self, func, **labels) -> None:
+        """ Read the value from func at scrape time, for things like queue depth
+
+        Arguments:
+            func {callable} -- Takes no arguments, returns the current value
+        """
+        self.values[self._key(labels)] = func
+
+    def samples(self) -> list:
+        lines = []
+        for key, value in sorted(self.values.items()):
+            try:
+                value = value() if callable(value) else value
+            except Exception as e:
+                log.warning('gauge=%s read failed: %s', self.name, e)
+                continue
+            lines.append(f'{self.name}{self._format_labels(key)} {value}')
+
+        return lines
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    # Seconds, from a cache hit up to a slow OCR request
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name: str, description: str, labels=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, description, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            # [count per bucket..., +Inf count, sum]
+            series = self.values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def samples(self) -> list:
+        lines = []
+        for key, series in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{self._format_labels(key, [("le", str(bound))])} {cumulative}')
+            lines.append(f'{self.name}_sum{self._format_labels(key)} {series[-1]}')
+            lines.append(f'{self.name}_count{self._format_labels(key)} {cumulative}')
+
+        return lines
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric) -> None:
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """ Every registered metric in the Prometheus text exposition format
+
+        Returns:
+            str -- Body for the /metrics endpoint
+        """
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metrics_Server():
+    """ Serves REGISTRY on /metrics for Prometheus to scrape """
+
+    def __init__(self, host='127.0.0.1', port=9100, registry=REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.runner = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+        log.info('metrics endpoint listening on http://%s:%d/metrics', self.host, self.port)
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(),
+                            content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+def setup_logging(level: str) -> None:
+    """ Leveled key=value logging to stdout for the bot's own modules
+
+    Arguments:
+        level {str} -- DEBUG, INFO, WARNING, ERROR or OFF to silence everything
+    """
+    level = level.upper()
+
+    logging.basicConfig(format='%(asctime)s level=%(levelname)s logger=%(name)s %(message)s',
+                        level=logging.WARNING)
+
+    if level == 'OFF':
+        logging.disable(logging.CRITICAL)
+        return
+
+    for name in ('lib', 'pipeline', 'download', 'ocr', 'ocr_cache', 'dedup', 'sql', 'es_db', 'metrics',
+                 'job_queue', 'main', 'worker', 'triggers', 'webhooks',
+                 'rate_limit'):
+        logging.getLogger(name).setLevel(level)
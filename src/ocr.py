@@ -0,0 +1,264 @@
+import asyncio
+import time
+
+from collections import deque
+from google.cloud import vision
+from metrics import Histogram
+from preprocess import preprocess_image, get_process_pool
+
+
+OCR_SECONDS = Histogram('ocr_seconds', 'Time to OCR one image, including time waiting for a batch', ['backend'])
+VISION_BATCH_SIZE = Histogram('vision_batch_size', 'Images per batch_annotate_images RPC',
+                              buckets=(1, 2, 4, 8, 16, 32, 64))
+VISION_RPC_SECONDS = Histogram('vision_rpc_seconds', 'Time for one batch_annotate_images RPC')
+
+
+class Vision_Batcher():
+    """ Collects images waiting for OCR and sends them to Google Vision together
+    with batch_annotate_images. A batch is sent when it reaches max_batch images,
+    when adding another image would go over max_bytes, or when the oldest image
+    has waited for window seconds.
+    """
+
+    def __init__(self, client: vision.ImageAnnotatorClient, max_batch=16, window=0.05, max_bytes=10000000):
+        self.client = client
+        self.max_batch = max_batch
+        self.window = window
+        self.max_bytes = max_bytes
+
+        self.pending = []
+        self.pending_bytes = 0
+        self.timer = None
+
+        self.rpcs = 0
+        self.images = 0
+
+    async def detect_text(self, content: bytes) -> str:
+        """ Queue an image for the next batch and wait for its text
+
+        Arguments:
+            content {bytes} -- Raw image bytes
+
+        Returns:
+            str -- Detected text with newlines replaced by spaces, empty if none was found
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        # Send what we have first if this image would push the request over the limit
+        if self.pending and self.pending_bytes + len(content) > self.max_bytes:
+            self._flush()
+
+        self.pending.append((content, future))
+        self.pending_bytes += len(content)
+
+        if len(self.pending) >= self.max_batch or self.pending_bytes >= self.max_bytes:
+            self._flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if not self.pending:
+            return
+
+        batch = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+
+        asyncio.ensure_future(self._send(batch))
+
+    async def _send(self, batch: list) -> None:
+        requests = [vision.types.AnnotateImageRequest(
+            image=vision.types.Image(content=content),
+            features=[vision.types.Feature(
+                type=vision.enums.Feature.Type.TEXT_DETECTION)]
+        ) for content, _ in batch]
+
+        self.rpcs += 1
+        self.images += len(batch)
+        VISION_BATCH_SIZE.observe(len(batch))
+
+        # The client is synchronous, keep the RPC off the event loop
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        try:
+            response = await loop.run_in_executor(None, self.client.batch_annotate_images, requests)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            VISION_RPC_SECONDS.observe(time.perf_counter() - start)
+
+        for (_, future), image_response in zip(batch, response.responses):
+            if future.done():
+                continue
+
+            if image_response.error.code:
+                future.set_exception(Exception(
+                    f'Vision error {image_response.error.code}: {image_response.error.message}'))
+                continue
+
+            annotations = image_response.text_annotations
+
+            if len(annotations) > 0:
+                text = annotations[0].description
+            else:
+                text = ''
+
+            future.set_result(text.replace('\n', ' '))
+
+    def stats(self) -> dict:
+        """ Number of RPCs sent and images OCR'ed so far
+
+        Returns:
+            dict -- rpcs, images and average batch size
+        """
+        return {
+            'rpcs': self.rpcs,
+            'images': self.images,
+            'avg_batch': self.images / self.rpcs if self.rpcs else 0.0
+        }
+
+
+class OCR_Backend():
+    """ Interface for OCR engines. Subclasses implement _detect_text, the
+    public detect_text records how long every image took.
+    """
+    name = ''
+
+    def __init__(self):
+        self.images = 0
+        self.latencies = deque(maxlen=1000)
+
+    async def detect_text(self, content: bytes) -> str:
+        """ OCR an image
+
+        Arguments:
+            content {bytes} -- Raw image bytes
+
+        Returns:
+            str -- Detected text with newlines replaced by spaces, empty if none was found
+        """
+        start = time.perf_counter()
+        text = await self._detect_text(content)
+        elapsed = time.perf_counter() - start
+        self.latencies.append(elapsed)
+        self.images += 1
+        OCR_SECONDS.observe(elapsed, backend=self.name)
+
+        return text
+
+    async def _detect_text(self, content: bytes) -> str:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        """ Per-image OCR latency over the last 1000 images
+
+        Returns:
+            dict -- images, average and 95th percentile latency in seconds
+        """
+        latencies = sorted(self.latencies)
+
+        return {
+            'images': self.images,
+            'avg_seconds': sum(latencies) / len(latencies) if latencies else 0.0,
+            'p95_seconds': latencies[int(len(latencies) * 0.95)] if latencies else 0.0
+        }
+
+
+class Vision_Backend(OCR_Backend):
+    name = 'vision'
+
+    def __init__(self, client: vision.ImageAnnotatorClient, max_batch=16, window=0.05, max_bytes=10000000):
+        super().__init__()
+        self.batcher = Vision_Batcher(client, max_batch=max_batch,
+                                      window=window, max_bytes=max_bytes)
+
+    async def _detect_text(self, content: bytes) -> str:
+        return await self.batcher.detect_text(content)
+
+    def stats(self) -> dict:
+        result = super().stats()
+        result.update(self.batcher.stats())
+
+        return result
+
+
+# Tesseract API handle, one per worker process
+_tesseract_api = None
+
+
+def tesseract_detect_text(content: bytes, lang: str, max_side: int) -> str:
+    """ Preprocess and OCR an image with Tesseract, runs inside a worker process
+
+    Arguments:
+        content {bytes} -- Raw image bytes
+        lang {str} -- Tesseract language
+        max_side {int} -- Longest side in pixels after downscaling
+
+    Returns:
+        str -- Detected text with newlines replaced by spaces
+    """
+    global _tesseract_api
+    if _tesseract_api is None:
+        import tesserocr
+        _tesseract_api = tesserocr.PyTessBaseAPI(lang=lang)
+
+    image = preprocess_image(content, max_side=max_side, binarise=True)
+
+    _tesseract_api.SetImage(image)
+    text = _tesseract_api.GetUTF8Text()
+
+    return ' '.join(text.split())
+
+
+class Tesseract_Backend(OCR_Backend):
+    """ Local OCR with tesserocr, spread over the shared process pool so every core is used """
+    name = 'tesseract'
+
+    def __init__(self, pool_size=0, lang='eng', max_side=2000):
+        super().__init__()
+        self.lang = lang
+        self.max_side = max_side
+        self.pool = get_process_pool(pool_size)
+
+    async def _detect_text(self, content: bytes) -> str:
+        loop = asyncio.get_event_loop()
+
+        return await loop.run_in_executor(self.pool, tesseract_detect_text,
+                                          content, self.lang, self.max_side)
+
+
+def create_backend(config: dict) -> OCR_Backend:
+    """ Create the OCR backend selected by the "ocr-backend" config key
+
+    Arguments:
+        config {dict} -- Contents of config.json
+
+    Returns:
+        OCR_Backend -- Vision_Backend or Tesseract_Backend
+    """
+    backend = config['ocr-backend']
+
+    if backend == 'vision':
+        return Vision_Backend(vision.ImageAnnotatorClient(),
+                              max_batch=config['vision-batch-size'],
+                              window=config['vision-batch-window-ms'] / 1000,
+                              max_bytes=config['vision-batch-max-bytes'])
+    elif backend == 'tesseract':
+        return Tesseract_Backend(pool_size=config['ocr-pool-size'],
+                                 lang=config['tesseract-lang'],
+                                 max_side=config['ocr-max-side'])
+    else:
+        raise ValueError(f'Unknown OCR backend: {backend}')
@@ -0,0 +1,133 @@
+import time
+import zlib
+
+from metrics import Counter
+from sql import Async_Sqlite
+
+
+OCR_CACHE_LOOKUPS = Counter('ocr_cache_lookups_total', 'OCR cache lookups by outcome', ['result'])
+
+
+class OCR_Cache():
+    """ OCR text keyed by the MD5 of the image, shared by every guild so a meme
+    posted in many servers is only OCR'ed once. Text is zlib compressed in a
+    sqlite file, and the least recently used entries are evicted once the
+    stored text goes over max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes=200000000):
+        self.max_bytes = max_bytes
+        self.db = Async_Sqlite(path)
+        self.db.run_sync(self._create_table)
+        self.total_bytes = self.db.run_sync(
+            lambda connection: connection.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_cache;").fetchone()[0])
+
+        self.evicting = False
+        self.hits = 0
+        self.misses = 0
+
+    def _create_table(self, connection) -> None:
+        sql_command = """
+        CREATE TABLE IF NOT EXISTS ocr_cache (
+        hash VARCHAR(32) NOT NULL PRIMARY KEY,
+        text BLOB NOT NULL,
+        size INTEGER NOT NULL,
+        last_used INTEGER NOT NULL
+        );
+        """
+        connection.execute(sql_command)
+
+        sql_command = """
+        CREATE INDEX IF NOT EXISTS ocr_cache_last_used ON ocr_cache (last_used);
+        """
+        connection.execute(sql_command)
+        connection.commit()
+
+    async def get(self, hash: str) -> str:
+        """ Look up previously detected text
+
+        Arguments:
+            hash {str} -- MD5 hash of the image
+
+        Returns:
+            str -- Cached text (possibly empty), None if the image hasn't been OCR'ed before
+        """
+        sql_command = """
+        SELECT text FROM ocr_cache WHERE hash = ?;
+        """
+        rows = await self.db.fetchall(sql_command, (hash,))
+
+        if not rows:
+            self.misses += 1
+            OCR_CACHE_LOOKUPS.inc(result='miss')
+            return None
+
+        self.hits += 1
+        OCR_CACHE_LOOKUPS.inc(result='hit')
+
+        sql_command = """
+        UPDATE ocr_cache SET last_used = ? WHERE hash = ?;
+        """
+        self.db.write(sql_command, (int(time.time()), hash))
+
+        return zlib.decompress(rows[0][0]).decode()
+
+    async def put(self, hash: str, text: str) -> None:
+        """ Store detected text, evicting old entries if the cache is full
+
+        Arguments:
+            hash {str} -- MD5 hash of the image
+            text {str} -- Detected text
+        """
+        compressed = zlib.compress(text.encode())
+
+        sql_command = """
+        INSERT OR IGNORE INTO ocr_cache (hash, text, size, last_used) VALUES (?, ?, ?, ?);
+        """
+        self.db.write(sql_command, (hash, compressed,
+                                    len(compressed), int(time.time())))
+        self.total_bytes += len(compressed)
+
+        if self.total_bytes > self.max_bytes and not self.evicting:
+            self.evicting = True
+            try:
+                await self.db.flush()
+                self.total_bytes = await self.db.run(self._evict)
+            finally:
+                self.evicting = False
+
+    async def close(self) -> None:
+        await self.db.close()
+
+    def _evict(self, connection) -> int:
+        # Evict down to 90% so we don't evict again on the very next insert
+        total_bytes = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM ocr_cache;").fetchone()[0]
+        target = self.max_bytes * 0.9
+
+        sql_command = """
+        SELECT hash, size FROM ocr_cache ORDER BY last_used LIMIT 1000;
+        """
+        evicted = []
+        for old_hash, size in connection.execute(sql_command).fetchall():
+            if total_bytes <= target:
+                break
+            evicted.append((old_hash,))
+            total_bytes -= size
+
+        connection.executemany("DELETE FROM ocr_cache WHERE hash = ?;", evicted)
+        connection.commit()
+
+        return total_bytes
+
+    def stats(self) -> dict:
+        """ Hit and miss counters for the stats command
+
+        Returns:
+            dict -- hits, misses and stored bytes
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes': self.total_bytes
+        }
@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+from datetime import timezone
+from metrics import Counter, Gauge, Histogram
+
+
+log = logging.getLogger(__name__)
+
+STAGE_SECONDS = Histogram('pipeline_stage_seconds', 'Time a worker spent on one job', ['stage'])
+STAGE_JOBS = Counter('pipeline_jobs_total', 'Jobs handled by each stage', ['stage', 'result'])
+QUEUE_DEPTH = Gauge('pipeline_queue_depth', 'Jobs waiting in front of each stage', ['stage'])
+
+
+class Image_Job():
+    """ A single image moving through the ingestion pipeline. Only plain
+    message metadata is kept so the job does not hold on to discord.py objects,
+    and can be handed to a worker process with to_dict()/from_dict().
+    """
+
+    # Message metadata, everything needed to build the Attachment
+    FIELDS = ('url', 'guild_id', 'guild', 'channel', 'channel_id', 'category_id', 'author_id',
+              'author_username', 'message_url', 'timestamp')
+
+    def __init__(self, url: str, message: discord.message.Message):
+        self.url = url
+        self.guild_id = message.guild.id
+        self.guild = message.guild.name
+        self.channel = message.channel.name
+        self.channel_id = message.channel.id
+        self.category_id = message.channel.category_id
+        self.author_id = message.author.id
+        self.author_username = message.author.name + "#" + message.author.discriminator
+        self.message_url = message.jump_url
+        self.timestamp = int(message.created_at.replace(
+            tzinfo=timezone.utc).timestamp() * 1000)
+
+        # Filled in by the pipeline stages
+        self.image = None
+        self.file_type = None
+        self.hash = None
+        self.dhash = None
+        self.text = None
+        self.future = None
+
+    def to_dict(self) -> dict:
+        """ The message metadata as a JSON serialisable dict
+
+        Returns:
+            dict -- One key per name in FIELDS
+        """
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Image_Job:
+        """ Rebuild a job from to_dict(), e.g. in an ingestion worker
+
+        Arguments:
+            data {dict} -- Output of to_dict()
+
+        Returns:
+            Image_Job -- New job that hasn't been through any stage yet
+        """
+        job = cls.__new__(cls)
+        # Jobs queued before a field was added don't have it
+        for field in cls.FIELDS:
+            setattr(job, field, data.get(field))
+
+        job.image = None
+        job.file_type = None
+        job.hash = None
+        job.dhash = None
+        job.text = None
+        job.future = None
+
+        return job
+
+    def finish(self, result) -> None:
+        """ Resolve the future of whoever submitted this job
+
+        Arguments:
+            result -- The job itself if it made it through every stage, None if it was dropped
+        """
+        if self.future and not self.future.done():
+            self.future.set_result(result)
+
+    def __repr__(self):
+        return f'<Image_Job {self.url}>'
+
+
+class Stage():
+    def __init__(self, name: str, func, workers: int):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = None
+
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy_time = 0.0
+
+
+class Ingestion_Pipeline():
+    """ Chain of asyncio queues, each drained by a fixed number of workers.
+
+    Every stage is a coroutine that takes a job and returns it to pass it on
+    to the next stage, or None to drop it. Queues are bounded so a burst of
+    images makes submit() wait instead of piling up unbounded work.
+    """
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self.stages = []
+        self.tasks = []
+        self.started_at = None
+
+    def add_stage(self, name: str, func, workers=1) -> None:
+        """ Append a stage to the end of the pipeline
+
+        Arguments:
+            name {str} -- Name used in stats and logs
+            func {coroutine function} -- Takes a job, returns the job or None to drop it
+
+        Keyword Arguments:
+            workers {int} -- Number of concurrent workers for this stage (default: {1})
+        """
+        stage = Stage(name, func, workers)
+        self.stages.append(stage)
+
+        QUEUE_DEPTH.set_function(lambda: stage.queue.qsize() if stage.queue else 0, stage=name)
+
+    def start(self) -> None:
+        """ Create the queues and spawn the workers, must be called from the running loop """
+        for stage in self.stages:
+            stage.queue = asyncio.Queue(maxsize=self.queue_size)
+
+        for i, stage in enumerate(self.stages):
+            next_stage = self.stages[i+1] if i + 1 < len(self.stages) else None
+            for _ in range(stage.workers):
+                self.tasks.append(asyncio.ensure_future(
+                    self._worker(stage, next_stage)))
+
+        self.started_at = time.monotonic()
+
+    async def stop(self) -> None:
+        """ Wait for queued jobs to drain then cancel the workers """
+        for stage in self.stages:
+            await stage.queue.join()
+
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def submit(self, job: Image_Job) -> asyncio.Future:
+        """ Queue a job at the first stage, waiting if the queue is full
+
+        Arguments:
+            job {Image_Job} -- Job to process
+
+        Returns:
+            asyncio.Future -- Resolves to the job once finished, or None if it was dropped
+        """
+        if not self.tasks:
+            self.start()
+
+        job.future = asyncio.get_event_loop().create_future()
+        await self.stages[0].queue.put(job)
+
+        return job.future
+
+    async def _worker(self, stage: Stage, next_stage: Stage) -> None:
+        while True:
+            job = await stage.queue.get()
+
+            start = time.perf_counter()
+            try:
+                result = await stage.func(job)
+                outcome = 'passed' if result is not None else 'dropped'
+            except Exception as e:
+                log.error('stage=%s job=%r error=%r', stage.name, job, e)
+                stage.errors += 1
+                result = None
+                outcome = 'error'
+            elapsed = time.perf_counter() - start
+            stage.busy_time += elapsed
+            stage.processed += 1
+            STAGE_SECONDS.observe(elapsed, stage=stage.name)
+            STAGE_JOBS.inc(stage=stage.name, result=outcome)
+
+            if result is None:
+                stage.dropped += 1
+                job.finish(None)
+            elif next_stage is None:
+                job.finish(result)
+            else:
+                await next_stage.queue.put(result)
+
+            stage.queue.task_done()
+
+    def stats(self) -> list:
+        """ Queue depth and throughput of every stage
+
+        Returns:
+            list -- One dict per stage
+        """
+        uptime = time.monotonic() - self.started_at if self.started_at else 0
+
+        result = []
+        for stage in self.stages:
+            result.append({
+                'name': stage.name,
+                'workers': stage.workers,
+                'queued': stage.queue.qsize() if stage.queue else 0,
+                'processed': stage.processed,
+                'dropped': stage.dropped,
+                'errors': stage.errors,
+                'per_second': stage.processed / uptime if uptime else 0.0,
+                'avg_seconds': stage.busy_time / stage.processed if stage.processed else 0.0
+            })
+
+        return result
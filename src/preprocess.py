@@ -0,0 +1,122 @@
+import io
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps, ImageStat
+
+# Shared by everything that does CPU heavy image work, created on first use
+_process_pool = None
+
+
+def get_process_pool(size=0) -> ProcessPoolExecutor:
+    """ Process pool shared by the preprocessing stage and the tesseract backend
+
+    Keyword Arguments:
+        size {int} -- Number of worker processes, 0 for one per core. Only used the first time (default: {0})
+
+    Returns:
+        ProcessPoolExecutor -- The shared pool
+    """
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=size or os.cpu_count())
+
+    return _process_pool
+
+
+def close_process_pool() -> None:
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False)
+        _process_pool = None
+
+
+def preprocess_image(content: bytes, max_side=2000, binarise=True) -> Image.Image:
+    """ Prepare an image for OCR: grayscale, shrink to at most max_side pixels on
+    the longest side and optionally threshold it to black and white
+
+    Arguments:
+        content {bytes} -- Raw image bytes
+
+    Keyword Arguments:
+        max_side {int} -- Longest side in pixels after downscaling (default: {2000})
+        binarise {bool} -- Threshold the grayscale image around its mean (default: {True})
+
+    Returns:
+        Image.Image -- Preprocessed PIL image
+    """
+    image = Image.open(io.BytesIO(content))
+
+    # Animated images, only the first frame is used
+    image.seek(0)
+
+    image = ImageOps.grayscale(image)
+
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    if binarise:
+        threshold = ImageStat.Stat(image).mean[0]
+        image = image.point(lambda p: 255 if p > threshold else 0)
+
+    return image
+
+
+def needs_shrinking(content: bytes, max_side=2000, max_bytes=10000000) -> bool:
+    """ Check if an image is over either limit, only the header is read so it's
+    cheap enough to call on the event loop
+
+    Arguments:
+        content {bytes} -- Raw image bytes
+
+    Keyword Arguments:
+        max_side {int} -- Longest side in pixels the OCR backend should get (default: {2000})
+        max_bytes {int} -- Largest image the OCR backend accepts (default: {10000000})
+
+    Returns:
+        bool -- True if it's too large, or its header couldn't be read
+    """
+    if len(content) > max_bytes:
+        return True
+
+    try:
+        return max(Image.open(io.BytesIO(content)).size) > max_side
+    except Exception:
+        return True
+
+
+def shrink_image(content: bytes, max_side=2000, max_bytes=10000000) -> bytes:
+    """ Downscale and grayscale an image then re-encode it as compactly as possible
+    for OCR, runs inside a worker process
+
+    Arguments:
+        content {bytes} -- Raw image bytes
+
+    Keyword Arguments:
+        max_side {int} -- Longest side in pixels after downscaling (default: {2000})
+        max_bytes {int} -- Largest image the OCR backend accepts (default: {10000000})
+
+    Returns:
+        bytes -- The smaller of the original and the re-encoded image, None if neither fits in max_bytes
+    """
+    if not needs_shrinking(content, max_side=max_side, max_bytes=max_bytes):
+        return content
+
+    image = preprocess_image(content, max_side=max_side, binarise=False)
+
+    # Lossless PNG keeps text edges sharp, JPEG is the fallback for big photos.
+    # Fast compression, a few more bytes cost less than seconds of CPU per image.
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', compress_level=1)
+    if buffer.tell() > max_bytes:
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=85)
+
+    shrunk = buffer.getvalue()
+
+    if len(content) <= len(shrunk) and len(content) <= max_bytes:
+        return content
+    elif len(shrunk) <= max_bytes:
+        return shrunk
+    else:
+        return None
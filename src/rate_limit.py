@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import time
+
+from collections import OrderedDict, deque
+from metrics import Gauge, Histogram
+
+
+log = logging.getLogger(__name__)
+
+RATE_LIMIT_WAIT_SECONDS = Histogram('rate_limit_wait_seconds', 'Time spent waiting for a rate limit token',
+                                    ['scheduler'], buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                                                            5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
+RATE_LIMIT_WAITING = Gauge('rate_limit_waiting', 'Calls queued for a rate limit token', ['scheduler'])
+
+
+class Fair_Scheduler():
+    """ Token bucket shared by every guild. Tokens refill at rate per second up to
+    burst, and each call takes one. Once they run out calls wait in a queue per
+    guild and tokens are handed out round robin across the guilds that are
+    waiting, so one busy guild only delays its own calls.
+
+    Calls are always delayed rather than dropped. A rate of 0 turns the limit off.
+    """
+
+    def __init__(self, name: str, rate: float, burst=1):
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1)
+
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+
+        # guild ID -> deque of futures, in the order the guilds get their next token
+        self.waiting = OrderedDict()
+        self.dispatcher = None
+
+        self.granted = 0
+        self.delayed = 0
+        self.wait_seconds = 0.0
+
+        RATE_LIMIT_WAITING.set_function(lambda: sum(len(q) for q in self.waiting.values()), scheduler=name)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def wait(self, guild_id) -> None:
+        """ Wait until the guild can make the call
+
+        Arguments:
+            guild_id -- Discord guild ID the call is made for
+        """
+        if self.rate <= 0:
+            return
+
+        self._refill()
+
+        # Only skip the queue if nobody is in it, otherwise it wouldn't be fair
+        if not self.waiting and self.tokens >= 1:
+            self.tokens -= 1
+            self.granted += 1
+            RATE_LIMIT_WAIT_SECONDS.observe(0, scheduler=self.name)
+            return
+
+        start = time.monotonic()
+        future = asyncio.get_event_loop().create_future()
+        self.waiting.setdefault(str(guild_id), deque()).append(future)
+
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.ensure_future(self._dispatch())
+
+        await future
+
+        waited = time.monotonic() - start
+        self.granted += 1
+        self.delayed += 1
+        self.wait_seconds += waited
+        RATE_LIMIT_WAIT_SECONDS.observe(waited, scheduler=self.name)
+
+        log.debug('scheduler=%s guild_id=%s waited=%.3fs', self.name, guild_id, waited)
+
+    async def _dispatch(self) -> None:
+        """ Hand out tokens to the waiting guilds in turn as they refill """
+        while self.waiting:
+            guild_id, queue = self.waiting.popitem(last=False)
+
+            # Skip calls that were cancelled while they waited, they don't use a token
+            while queue and queue[0].done():
+                queue.popleft()
+
+            if not queue:
+                continue
+
+            self._refill()
+
+            if self.tokens < 1:
+                # The guild keeps its turn until the next token
+                self.waiting[guild_id] = queue
+                self.waiting.move_to_end(guild_id, last=False)
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+
+            queue.popleft().set_result(None)
+            self.tokens -= 1
+
+            # Back of the line for the guild's next call
+            if queue:
+                self.waiting[guild_id] = queue
+
+    def stats(self) -> dict:
+        """ Counters for the stats command
+
+        Returns:
+            dict -- calls granted, how many had to wait, the average wait and calls waiting now
+        """
+        return {
+            'granted': self.granted,
+            'delayed': self.delayed,
+            'avg_wait': self.wait_seconds / self.delayed if self.delayed else 0.0,
+            'waiting': sum(len(queue) for queue in self.waiting.values())
+        }
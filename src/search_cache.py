@@ -0,0 +1,129 @@
+import time
+
+from collections import OrderedDict
+from metrics import Counter
+
+
+SEARCH_CACHE_LOOKUPS = Counter('search_cache_lookups_total', 'Search cache lookups by outcome', ['result'])
+
+
+class Search_Cache():
+    """ Pages of search results per guild, keyed by the normalised query, page
+    size and search_after. Entries expire after ttl seconds, the
+    least recently used go once there are more than capacity, and every entry
+    for a guild is dropped as soon as new attachments are written to it.
+
+    Elasticsearch only makes writes searchable after a refresh, so for
+    refresh_window seconds after an invalidation results aren't cached, they
+    could be missing the new attachments.
+    """
+
+    def __init__(self, capacity=1000, ttl=300, refresh_window=1.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.refresh_window = refresh_window
+
+        # key -> (expires at, value)
+        self.entries = OrderedDict()
+        self.guild_keys = {}
+        self.invalidated_at = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, guild_id: str, query_key: tuple, size: int, search_after: list, offset=0,
+            track_total=True) -> tuple:
+        """ Cache key for a page of a search
+
+        Arguments:
+            guild_id {str} -- Discord guild ID
+            query_key {tuple} -- Search_Query.key(), normalised phrase, filters and sort
+            size {int} -- Page size
+            search_after {list} -- Sort values the page starts after, None for the first page
+
+        Keyword Arguments:
+            offset {int} -- Results skipped to reach the page without search_after (default: {0})
+            track_total {bool} -- Whether the page counts every match (default: {True})
+
+        Returns:
+            tuple -- Hashable key
+        """
+        return (str(guild_id), query_key, size, tuple(search_after) if search_after else None, offset, track_total)
+
+    def get(self, key: tuple):
+        """ Look up a cached page
+
+        Arguments:
+            key {tuple} -- From key()
+
+        Returns:
+            The cached value, None if it's missing or expired
+        """
+        entry = self.entries.get(key)
+
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            SEARCH_CACHE_LOOKUPS.inc(result='miss')
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        SEARCH_CACHE_LOOKUPS.inc(result='hit')
+
+        return entry[1]
+
+    def put(self, key: tuple, value) -> None:
+        """ Cache a page of results
+
+        Arguments:
+            key {tuple} -- From key()
+            value -- What search() returned
+        """
+        guild_id = key[0]
+        now = time.monotonic()
+
+        if now - self.invalidated_at.get(guild_id, float('-inf')) < self.refresh_window:
+            return
+
+        self.entries[key] = (now + self.ttl, value)
+        self.entries.move_to_end(key)
+        self.guild_keys.setdefault(guild_id, set()).add(key)
+
+        while len(self.entries) > self.capacity:
+            old_key = next(iter(self.entries))
+            self._remove(old_key)
+
+    def invalidate(self, guild_id: str) -> None:
+        """ Forget every cached search for the guild, called when attachments are written to it
+
+        Arguments:
+            guild_id {str} -- Discord guild ID
+        """
+        guild_id = str(guild_id)
+        self.invalidated_at[guild_id] = time.monotonic()
+
+        for key in self.guild_keys.pop(guild_id, ()):
+            self.entries.pop(key, None)
+
+    def _remove(self, key: tuple) -> None:
+        del self.entries[key]
+
+        keys = self.guild_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.guild_keys[key[0]]
+
+    def stats(self) -> dict:
+        """ Hit and miss counters for the stats command
+
+        Returns:
+            dict -- entries, hits and misses
+        """
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses
+        }
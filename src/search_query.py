@@ -0,0 +1,189 @@
+import re
+
+from datetime import datetime, timedelta, timezone
+from elasticsearch_dsl import Q
+
+
+USER_MENTION = re.compile(r'<@!?([0-9]+)>')
+CHANNEL_MENTION = re.compile(r'<#([0-9]+)>')
+USER_ID = re.compile(r'[0-9]{17,20}')
+
+SORTS = {
+    'relevance': ('_score', {'timestamp': 'desc'}),
+    'new': ({'timestamp': 'desc'},),
+    'old': ({'timestamp': 'asc'},)
+}
+
+FILE_TYPES = {'png': 'png', 'jpg': 'jpg', 'jpeg': 'jpg', 'gif': 'gif', 'webp': 'webp'}
+
+
+class Search_Query():
+    """ What to search for and how, parsed from the search command. Everything
+    except the phrase becomes a filter context clause, so elasticsearch narrows
+    the results without scoring them.
+    """
+
+    def __init__(self, phrase='', user_id=None, channel_id=None, before=None, after=None,
+                 file_type=None, sort='relevance', fuzzy=False, text=''):
+        self.phrase = phrase
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.before = before
+        self.after = after
+        self.file_type = file_type
+        self.sort = sort
+        self.fuzzy = fuzzy
+        self.text = text or phrase
+
+    def is_empty(self) -> bool:
+        return not (self.phrase or self.user_id or self.channel_id or self.before
+                    or self.after or self.file_type)
+
+    def key(self) -> tuple:
+        """ Hashable identity of the query, phrases differing only in case or spacing are equal
+
+        Returns:
+            tuple -- Key for the search cache
+        """
+        return (' '.join(self.phrase.lower().split()), self.user_id, self.channel_id,
+                self.before, self.after, self.file_type, self.sort, self.fuzzy)
+
+    def filters(self, guild_id: str) -> list:
+        """ Filter context clauses for everything but the phrase
+
+        Arguments:
+            guild_id {str} -- Server the search was made in
+
+        Returns:
+            list -- elasticsearch_dsl queries
+        """
+        filters = [Q('term', guild_id=int(guild_id))]
+
+        if self.user_id:
+            filters.append(Q('term', author_id=int(self.user_id)))
+
+        if self.channel_id:
+            filters.append(Q('term', channel_id=int(self.channel_id)))
+
+        if self.file_type:
+            filters.append(Q('term', file_type=self.file_type))
+
+        if self.before or self.after:
+            bounds = {}
+            if self.after:
+                bounds['gte'] = self.after
+            if self.before:
+                bounds['lt'] = self.before
+            filters.append(Q('range', timestamp=bounds))
+
+        return filters
+
+    def sort_fields(self, tiebreaker='url') -> tuple:
+        """ Sort for the query, ending with a unique field so search_after never
+        skips or repeats a result
+
+        Keyword Arguments:
+            tiebreaker {str} -- Field that's unique and sortable in every index searched (default: {'url'})
+
+        Returns:
+            tuple -- elasticsearch_dsl sort arguments
+        """
+        return SORTS[self.sort] + ({tiebreaker: 'asc'},)
+
+
+def parse_date(value: str) -> int:
+    """ Start of the given UTC day in epoch milliseconds, like the timestamp field
+
+    Arguments:
+        value {str} -- YYYY-MM-DD, today or yesterday
+
+    Returns:
+        int -- Milliseconds since the epoch
+    """
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    if value == 'today':
+        day = today
+    elif value == 'yesterday':
+        day = today - timedelta(days=1)
+    else:
+        try:
+            day = datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+        except ValueError:
+            raise ValueError(f'"{value}" isn\'t a date, use YYYY-MM-DD')
+
+    return int(day.timestamp() * 1000)
+
+
+def parse_search(text: str, channels: dict, fuzzy=False) -> Search_Query:
+    """ Parse the text after the search command. Besides the phrase it can contain
+        from:@user, in:#channel, before:YYYY-MM-DD, after:YYYY-MM-DD, type:gif and
+        sort:new, old or relevance. A bare user mention or ID also filters by user,
+        and a phrase in quotes has to match exactly.
+
+    Arguments:
+        text {str} -- Raw text after the command, with any quotes still in it
+        channels {dict} -- Channel IDs by lower case name, to resolve in:channel-name
+
+    Keyword Arguments:
+        fuzzy {bool} -- Tolerate OCR mistakes in unquoted phrases (default: {False})
+
+    Raises:
+        ValueError: With a message for the user if an operator has a bad value
+
+    Returns:
+        Search_Query -- The parsed query
+    """
+    query = Search_Query(fuzzy=fuzzy, text=text.strip())
+    words = []
+
+    for arg in text.split():
+        operator, _, value = arg.partition(':')
+        operator = operator.lower()
+
+        if value and operator == 'from':
+            mention = USER_MENTION.fullmatch(value)
+            if mention:
+                query.user_id = mention.group(1)
+            elif USER_ID.fullmatch(value):
+                query.user_id = value
+            else:
+                raise ValueError('Mention the user to search for, like from:@user')
+        elif value and operator == 'in':
+            match = CHANNEL_MENTION.fullmatch(value)
+            if match:
+                query.channel_id = match.group(1)
+            elif value.lstrip('#').lower() in channels:
+                query.channel_id = str(channels[value.lstrip('#').lower()])
+            else:
+                raise ValueError(f'There\'s no channel called {value}')
+        elif value and operator == 'before':
+            query.before = parse_date(value.lower())
+        elif value and operator == 'after':
+            # After a day means from the start of the next one
+            query.after = parse_date(value.lower()) + 24 * 60 * 60 * 1000
+        elif value and operator == 'type':
+            if value.lower() not in FILE_TYPES:
+                raise ValueError(f'Image type has to be one of {", ".join(sorted(set(FILE_TYPES.values())))}')
+            query.file_type = FILE_TYPES[value.lower()]
+        elif value and operator == 'sort':
+            if value.lower() not in SORTS:
+                raise ValueError(f'Sort has to be one of {", ".join(SORTS)}')
+            query.sort = value.lower()
+        elif USER_MENTION.fullmatch(arg):
+            query.user_id = USER_MENTION.fullmatch(arg).group(1)
+        elif USER_ID.fullmatch(arg) and query.user_id is None:
+            query.user_id = arg
+        else:
+            words.append(arg)
+
+    phrase = ' '.join(words).strip()
+
+    # A quoted phrase has to match exactly, anything else tolerates OCR mistakes
+    if len(phrase) > 1 and phrase[0] in '"“' and phrase[-1] in '"”':
+        phrase = phrase[1:-1].strip()
+        query.fuzzy = False
+
+    query.phrase = phrase
+
+    return query
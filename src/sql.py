@@ -1,10 +1,142 @@
+import asyncio
+import logging
 import sqlite3
 
+from concurrent.futures import ThreadPoolExecutor
+
+
+log = logging.getLogger(__name__)
+
+
+class Async_Sqlite():
+    """ A sqlite connection owned by its own thread so queries never run on the
+    event loop. Reads are awaited, writes are queued and committed together in
+    a single transaction shortly after they are made.
+    """
+
+    def __init__(self, path: str, flush_delay=0.05):
+        self.flush_delay = flush_delay
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.connection = self.executor.submit(self._connect, path).result()
+
+        self.pending = []
+        self.flush_task = None
+
+    def _connect(self, path: str) -> sqlite3.Connection:
+        connection = sqlite3.connect(path, check_same_thread=False)
+
+        # WAL lets reads carry on during writes, NORMAL sync is safe with WAL
+        connection.execute("PRAGMA journal_mode=WAL;")
+        connection.execute("PRAGMA synchronous=NORMAL;")
+        connection.execute("PRAGMA busy_timeout=5000;")
+        connection.execute("PRAGMA temp_store=MEMORY;")
+        connection.execute("PRAGMA cache_size=-16000;")
+
+        return connection
+
+    def run_sync(self, func, *args):
+        """ Run func(connection, *args) on the sqlite thread and block for the result,
+        only for startup before the event loop is running
+
+        Arguments:
+            func {callable} -- Takes the connection as its first argument
+
+        Returns:
+            Whatever func returns
+        """
+        return self.executor.submit(func, self.connection, *args).result()
+
+    async def run(self, func, *args):
+        """ Run func(connection, *args) on the sqlite thread
+
+        Arguments:
+            func {callable} -- Takes the connection as its first argument
+
+        Returns:
+            Whatever func returns
+        """
+        loop = asyncio.get_event_loop()
+
+        return await loop.run_in_executor(self.executor, func, self.connection, *args)
+
+    async def fetchall(self, sql_command: str, params=()) -> list:
+        return await self.run(lambda connection: connection.execute(sql_command, params).fetchall())
+
+    def write(self, sql_command: str, params=()) -> None:
+        """ Queue a write, it's committed with any others made in the next flush_delay seconds
+
+        Arguments:
+            sql_command {str} -- INSERT/UPDATE/DELETE statement
+            params {tuple} -- Statement parameters
+        """
+        self.pending.append((sql_command, params))
+
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def flush(self) -> None:
+        """ Commit every queued write in one transaction """
+        if not self.pending:
+            return
+
+        writes = self.pending
+        self.pending = []
+
+        await self.run(self._commit, writes)
+
+    async def close(self) -> None:
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+
+        await self.flush()
+        self.executor.submit(self.connection.close).result()
+        self.executor.shutdown(wait=True)
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        self.flush_task = None
+        await self.flush()
+
+    def _commit(self, connection: sqlite3.Connection, writes: list) -> None:
+        for sql_command, params in writes:
+            try:
+                connection.execute(sql_command, params)
+            except Exception as e:
+                log.error('statement=%r error=%r', sql_command, e)
+
+        connection.commit()
+
 
 class Sqlite3_db():
-    def __init__(self):
-        self.connection = sqlite3.connect("sql/sql.db")
-        self.cursor = self.connection.cursor()
+    """ Blacklisted channels, admins and image hashes. Lookups are served from
+    memory and writes go through Async_Sqlite, so nothing here blocks the event loop.
+    """
+
+    def __init__(self, path="sql/sql.db"):
+        self.db = Async_Sqlite(path)
+        self.db.run_sync(self._create_tables)
+
+        # In-memory copies of the access control tables, kept up to date on every write
+        self.blacklisted_channels = {}
+        self.admins = {}
+
+        for guild_id, channel_id in self.db.run_sync(self._fetchall, "SELECT guild_id, channel_id FROM blacklisted_channels;"):
+            self.blacklisted_channels.setdefault(guild_id, set()).add(channel_id)
+
+        for guild_id, user_id in self.db.run_sync(self._fetchall, "SELECT guild_id, user_id FROM admins;"):
+            self.admins.setdefault(guild_id, set()).add(user_id)
+
+        self.backfill_checkpoints = dict(self.db.run_sync(
+            self._fetchall, "SELECT channel_id, last_message_id FROM backfill_checkpoints;"))
+
+        return
+
+    def _fetchall(self, connection: sqlite3.Connection, sql_command: str, params=()) -> list:
+        return connection.execute(sql_command, params).fetchall()
+
+    def _create_tables(self, connection: sqlite3.Connection) -> None:
+        cursor = connection.cursor()
 
         # Create blacklisted_channels table
         sql_command = """
@@ -13,7 +145,7 @@ class Sqlite3_db():
         guild_id VARCHAR(30) NOT NULL 
         );
         """
-        self.cursor.execute(sql_command)
+        cursor.execute(sql_command)
 
         sql_command = """
         CREATE TABLE IF NOT EXISTS admins ( 
@@ -21,23 +153,46 @@ class Sqlite3_db():
         guild_id VARCHAR(30) NOT NULL 
         );
         """
-        self.cursor.execute(sql_command)
+        cursor.execute(sql_command)
 
-        self.connection.commit()
-        return
+        # Hashes of images already seen, used to warm the dedup cache on startup
+        sql_command = """
+        CREATE TABLE IF NOT EXISTS image_hashes (
+        guild_id VARCHAR(30) NOT NULL,
+        hash VARCHAR(32) NOT NULL,
+        dhash VARCHAR(64),
+        PRIMARY KEY (guild_id, hash)
+        );
+        """
+        cursor.execute(sql_command)
+
+        # Last message indexed by the backfill command in each channel
+        sql_command = """
+        CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+        channel_id VARCHAR(30) NOT NULL PRIMARY KEY,
+        guild_id VARCHAR(30) NOT NULL,
+        last_message_id VARCHAR(30) NOT NULL
+        );
+        """
+        cursor.execute(sql_command)
+
+        # Every lookup is by guild
+        cursor.execute("CREATE INDEX IF NOT EXISTS blacklisted_channels_guild_id ON blacklisted_channels (guild_id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS admins_guild_id ON admins (guild_id, user_id);")
+
+        connection.commit()
+
+    async def close(self):
+        await self.db.close()
 
     def add_blacklist_channel(self, guild_id: str, channel_id: str):
         guild_id = str(guild_id)
         channel_id = str(channel_id)
         sql_command = """
-        INSERT INTO blacklisted_channels (guild_id, channel_id) VALUES (?, ?);
+        INSERT OR IGNORE INTO blacklisted_channels (guild_id, channel_id) VALUES (?, ?);
         """
-        try:
-            self.cursor.execute(sql_command, (guild_id, channel_id))
-            self.connection.commit()
-        except Exception as e:
-            print(e)
-            return
+        self.blacklisted_channels.setdefault(guild_id, set()).add(channel_id)
+        self.db.write(sql_command, (guild_id, channel_id))
 
         return
 
@@ -48,13 +203,12 @@ class Sqlite3_db():
         INSERT INTO admins (guild_id, user_id) VALUES (?, ?);
         """
 
-        try:
-            self.cursor.execute(sql_command, (guild_id, user_id))
-            self.connection.commit()
-        except Exception as e:
-            print(e)
+        if self.is_admin(guild_id, user_id):
             return
 
+        self.admins.setdefault(guild_id, set()).add(user_id)
+        self.db.write(sql_command, (guild_id, user_id))
+
         return
 
     def remove_admin(self, guild_id: str, user_id: str):
@@ -64,12 +218,8 @@ class Sqlite3_db():
         DELETE FROM admins WHERE (guild_id=? AND user_id=?); 
         """
 
-        try:
-            self.cursor.execute(sql_command, (guild_id, user_id))
-            self.connection.commit()
-        except Exception as e:
-            print(e)
-            return
+        self.admins.get(guild_id, set()).discard(user_id)
+        self.db.write(sql_command, (guild_id, user_id))
 
         return
 
@@ -81,41 +231,71 @@ class Sqlite3_db():
         DELETE FROM blacklisted_channels WHERE (guild_id=? AND channel_id=?); 
         """
 
-        try:
-            self.cursor.execute(sql_command, (guild_id, channel_id))
-            self.connection.commit()
-        except Exception as e:
-            print(e)
-            return
+        self.blacklisted_channels.get(guild_id, set()).discard(channel_id)
+        self.db.write(sql_command, (guild_id, channel_id))
 
         return
 
     def get_blacklisted_channels(self, guild_id: str):
+        return set(self.blacklisted_channels.get(str(guild_id), ()))
+
+    def get_admins(self, guild_id: str):
+        return set(self.admins.get(str(guild_id), ()))
+
+    def is_blacklisted(self, guild_id: str, channel_id: str):
+        return str(channel_id) in self.blacklisted_channels.get(str(guild_id), ())
+
+    def is_admin(self, guild_id: str, user_id: str):
+        return str(user_id) in self.admins.get(str(guild_id), ())
+
+    def get_backfill_checkpoint(self, channel_id: str):
+        return self.backfill_checkpoints.get(str(channel_id))
+
+    def set_backfill_checkpoint(self, guild_id: str, channel_id: str, message_id: str):
         guild_id = str(guild_id)
+        channel_id = str(channel_id)
+        message_id = str(message_id)
         sql_command = """
-        SELECT channel_id FROM blacklisted_channels WHERE guild_id = ?;
+        INSERT OR REPLACE INTO backfill_checkpoints (channel_id, guild_id, last_message_id) VALUES (?, ?, ?);
         """
-        self.cursor.execute(sql_command, (guild_id,))
-
-        result_tuples = self.cursor.fetchall()
-        print(result_tuples)
 
-        result = [t[0] for t in result_tuples]
-        print(result)
+        self.backfill_checkpoints[channel_id] = message_id
+        self.db.write(sql_command, (channel_id, guild_id, message_id))
 
-        return result
+        return
 
-    def get_admins(self, guild_id: str):
+    def add_image_hash(self, guild_id: str, hash: str, dhash: int):
         guild_id = str(guild_id)
+        dhash = format(dhash, 'x') if dhash is not None else None
+        sql_command = """
+        INSERT OR IGNORE INTO image_hashes (guild_id, hash, dhash) VALUES (?, ?, ?);
+        """
+
+        self.db.write(sql_command, (guild_id, hash, dhash))
+
+        return
+
+    def get_image_hashes(self, limit: int):
+        """ Most recently added image hashes, oldest first. Older rows past the
+        limit are deleted since the dedup cache would evict them anyway.
+        """
+        return self.db.run_sync(self._get_image_hashes, limit)
+
+    def _get_image_hashes(self, connection: sqlite3.Connection, limit: int):
         sql_command = """
-        SELECT user_id FROM admins WHERE guild_id = ?;
+        SELECT guild_id, hash, dhash FROM image_hashes ORDER BY rowid DESC LIMIT ?;
         """
-        self.cursor.execute(sql_command, (guild_id,))
+        result_tuples = connection.execute(sql_command, (limit,)).fetchall()
 
-        result_tuples = self.cursor.fetchall()
-        print(result_tuples)
+        if len(result_tuples) == limit:
+            sql_command = """
+            DELETE FROM image_hashes WHERE rowid NOT IN (
+            SELECT rowid FROM image_hashes ORDER BY rowid DESC LIMIT ?);
+            """
+            connection.execute(sql_command, (limit,))
+            connection.commit()
 
-        result = [t[0] for t in result_tuples]
-        print(result)
+        result = [(guild_id, hash, int(dhash, 16) if dhash else None)
+                  for guild_id, hash, dhash in reversed(result_tuples)]
 
         return result
@@ -0,0 +1,134 @@
+import json
+import logging
+import random
+import string
+
+from collections import Counter
+
+
+log = logging.getLogger(__name__)
+
+IGNORED_CHARACTERS = frozenset(string.whitespace + string.punctuation)
+
+
+class Trigger():
+    """ A phrase that makes the bot reply through a webhook when a message is an
+    anagram of it, ignoring case, whitespace and punctuation
+    """
+
+    def __init__(self, phrase: str, message: str, avatar_url: str):
+        self.phrase = phrase
+        self.message = message
+        self.avatar_url = avatar_url
+
+    def get_avatar_url(self) -> str:
+        """ The avatar URL with {random} replaced by 7 random letters, so it isn't cached
+
+        Returns:
+            str -- Avatar URL for the webhook
+        """
+        return self.avatar_url.replace('{random}', ''.join(random.choice(string.ascii_lowercase) for i in range(7)))
+
+
+def signature(text: str, max_length=None):
+    """ Count the characters an anagram has to share with the text
+
+    Arguments:
+        text {str} -- Text to count, case is ignored
+
+    Keyword Arguments:
+        max_length {int} -- Give up once more characters than this are counted (default: {None})
+
+    Returns:
+        tuple -- (number of characters, frozenset of (character, count) pairs),
+                 None if there are more than max_length
+    """
+    counts = Counter()
+    length = 0
+
+    for c in text.lower():
+        if c in IGNORED_CHARACTERS:
+            continue
+
+        length += 1
+        if max_length is not None and length > max_length:
+            return None
+
+        counts[c] += 1
+
+    return length, frozenset(counts.items())
+
+
+class Trigger_Matcher():
+    """ Triggers indexed by their signature, built once so each message costs one
+    pass over its characters no matter how many triggers there are. Messages
+    longer than the longest trigger are rejected as soon as that's clear.
+    """
+
+    def __init__(self, triggers=()):
+        # length -> {signature: trigger}
+        self.index = {}
+        self.max_length = 0
+
+        for trigger in triggers:
+            self.add(trigger)
+
+    def add(self, trigger: Trigger) -> None:
+        length, counts = signature(trigger.phrase)
+        if not length:
+            raise ValueError(f'Trigger "{trigger.phrase}" has no letters')
+
+        by_counts = self.index.setdefault(length, {})
+        if counts in by_counts:
+            log.warning('trigger=%r is an anagram of %r, ignoring it', trigger.phrase, by_counts[counts].phrase)
+            return
+
+        by_counts[counts] = trigger
+        self.max_length = max(self.max_length, length)
+
+    def match(self, text: str):
+        """ Find the trigger the text is an anagram of
+
+        Arguments:
+            text {str} -- Message content
+
+        Returns:
+            Trigger -- The matching trigger, None if there isn't one
+        """
+        if not self.index:
+            return None
+
+        result = signature(text, max_length=self.max_length)
+        if result is None:
+            return None
+
+        length, counts = result
+        by_counts = self.index.get(length)
+        if by_counts is None:
+            return None
+
+        return by_counts.get(counts)
+
+    def __len__(self) -> int:
+        return sum(len(by_counts) for by_counts in self.index.values())
+
+
+def load_triggers(path: str) -> Trigger_Matcher:
+    """ Build the matcher from a JSON file, a list of objects with phrase, message
+    and avatar-url keys
+
+    Arguments:
+        path {str} -- Path to the triggers file
+
+    Returns:
+        Trigger_Matcher -- Matcher for every trigger in the file
+    """
+    with open(path, 'r') as f:
+        entries = json.load(f)
+
+    matcher = Trigger_Matcher(Trigger(entry['phrase'], entry['message'], entry['avatar-url'])
+                              for entry in entries)
+
+    log.info('loaded triggers=%d from %s', len(matcher), path)
+
+    return matcher
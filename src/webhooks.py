@@ -0,0 +1,116 @@
+import aiohttp
+import asyncio
+import discord
+import logging
+
+from discord import Webhook, AsyncWebhookAdapter
+from metrics import Counter
+from rate_limit import Fair_Scheduler
+
+
+log = logging.getLogger(__name__)
+
+WEBHOOK_CALLS = Counter('webhook_calls_total', 'Discord API calls made for webhook replies', ['call'])
+
+
+class Webhook_Pool():
+    """ One webhook per channel, created the first time it's needed and reused for
+    every later send. Sends go straight to the webhook URL over one pooled aiohttp
+    session, so after the first reply in a channel each one is a single request.
+
+    A webhook deleted from outside the bot is recreated on the next send.
+    Sends wait for a token from scheduler first, if one is given.
+    """
+
+    def __init__(self, name: str, reason='', pool_size=10, scheduler: Fair_Scheduler = None):
+        self.name = name
+        self.reason = reason
+        self.pool_size = pool_size
+        self.scheduler = scheduler
+        self.session = None
+
+        # channel ID -> Webhook bound to the pooled session
+        self.webhooks = {}
+        self.locks = {}
+
+    async def send(self, channel: discord.TextChannel, content: str, avatar_url: str) -> None:
+        """ Send a message through the channel's webhook
+
+        Arguments:
+            channel {discord.TextChannel} -- Channel to send to
+            content {str} -- Message content
+            avatar_url {str} -- Avatar for this message
+        """
+        if self.scheduler is not None:
+            await self.scheduler.wait(channel.guild.id)
+
+        webhook = await self.get_webhook(channel)
+
+        try:
+            WEBHOOK_CALLS.inc(call='send')
+            await webhook.send(content=content, avatar_url=avatar_url)
+        except discord.NotFound:
+            # Deleted by someone else, forget it and try once more with a new one
+            log.info('channel_id=%d webhook_id=%d was deleted, recreating it', channel.id, webhook.id)
+            self.webhooks.pop(channel.id, None)
+            webhook = await self.get_webhook(channel)
+            WEBHOOK_CALLS.inc(call='send')
+            await webhook.send(content=content, avatar_url=avatar_url)
+
+    async def get_webhook(self, channel: discord.TextChannel) -> Webhook:
+        """ The pooled webhook for a channel, reusing one the bot made before it
+        restarted or creating a new one
+
+        Arguments:
+            channel {discord.TextChannel} -- Channel the webhook posts in
+
+        Returns:
+            Webhook -- Webhook that sends over the pooled session
+        """
+        webhook = self.webhooks.get(channel.id)
+        if webhook is not None:
+            return webhook
+
+        # Two triggers at once in a new channel shouldn't make two webhooks
+        lock = self.locks.setdefault(channel.id, asyncio.Lock())
+        async with lock:
+            webhook = self.webhooks.get(channel.id)
+            if webhook is not None:
+                return webhook
+
+            webhook = await self.find_webhook(channel)
+            if webhook is None:
+                webhook = await channel.create_webhook(name=self.name, reason=self.reason)
+                WEBHOOK_CALLS.inc(call='create')
+                log.info('channel_id=%d created webhook_id=%d', channel.id, webhook.id)
+
+            if self.session is None:
+                self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+
+            webhook = Webhook.partial(webhook.id, webhook.token, adapter=AsyncWebhookAdapter(self.session))
+            self.webhooks[channel.id] = webhook
+
+        return webhook
+
+    async def find_webhook(self, channel: discord.TextChannel):
+        """ A webhook with this pool's name that the bot created in the channel earlier
+
+        Arguments:
+            channel {discord.TextChannel} -- Channel to look in
+
+        Returns:
+            Webhook -- The existing webhook, None if there isn't one
+        """
+        WEBHOOK_CALLS.inc(call='list')
+
+        for webhook in await channel.webhooks():
+            if webhook.name == self.name and webhook.token is not None and \
+                    webhook.user is not None and webhook.user.id == channel.guild.me.id:
+                return webhook
+
+        return None
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
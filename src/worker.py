@@ -0,0 +1,94 @@
+import asyncio
+import functools
+import logging
+import os
+import signal
+import socket
+
+from lib import *
+
+# Ingestion worker for "ingest-mode": "queue". The gateway processes only put
+# image jobs in the shared job queue, any number of these download, hash and
+# OCR them with the usual pipeline and write the results to elasticsearch.
+
+log = logging.getLogger('worker')
+
+if job_queue is None:
+    raise SystemExit('worker.py needs "ingest-mode": "queue" in config.json')
+
+
+async def handle_queued_job(job_id: int, payload: dict) -> None:
+    try:
+        job = await run_job(Image_Job.from_dict(payload))
+        futures = await index_jobs([job])
+    except Exception as e:
+        # Left claimed, it's retried once the claim times out
+        log.error('job_id=%d failed: %r', job_id, e)
+        return
+
+    # Dropped jobs are done straight away, indexed ones once the bulk write with them is acked
+    if not futures:
+        job_queue.ack(job_id)
+        return
+
+    futures[0].add_done_callback(functools.partial(ack_saved_job, job_id))
+
+
+def ack_saved_job(job_id: int, future: asyncio.Future) -> None:
+    if future.result():
+        job_queue.ack(job_id)
+    else:
+        # Left claimed, it's retried once the claim times out
+        log.error('job_id=%d failed to save', job_id)
+
+
+async def run_worker() -> None:
+    """ Keep up to worker-concurrency jobs in flight, claiming more as they finish """
+    name = f'{socket.gethostname()}-{os.getpid()}'
+    concurrency = config['worker-concurrency']
+    poll_interval = config['worker-poll-interval']
+
+    log.info('worker=%s started concurrency=%d', name, concurrency)
+
+    in_flight = set()
+    try:
+        while True:
+            claimed = await job_queue.claim(concurrency - len(in_flight), name)
+            for job_id, payload in claimed:
+                in_flight.add(asyncio.ensure_future(handle_queued_job(job_id, payload)))
+
+            if not in_flight:
+                await asyncio.sleep(poll_interval)
+                continue
+
+            # Claim more as soon as a slot frees, or after poll_interval for newly queued jobs
+            _, in_flight = await asyncio.wait(in_flight, timeout=poll_interval,
+                                              return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        # Finish what was claimed, shutdown() then flushes and acks what's still buffered
+        await asyncio.gather(*in_flight, return_exceptions=True)
+
+
+async def main() -> None:
+    # The gateway process migrates older indices, workers only wait for it
+    await setup(migrate=False)
+
+    # Let gateway processes know which guilds' cached searches are stale
+    if db_connect:
+        db.add_write_listener(job_queue.mark_written)
+
+    try:
+        await run_worker()
+    finally:
+        await shutdown()
+
+
+loop = asyncio.get_event_loop()
+task = loop.create_task(main())
+for sig in (signal.SIGINT, signal.SIGTERM):
+    loop.add_signal_handler(sig, task.cancel)
+
+try:
+    loop.run_until_complete(task)
+except asyncio.CancelledError:
+    pass